@@ -3,153 +3,2812 @@
 # encoding workflow
 
 # variables
-input_dir="/app/videos/input"
-working_dir="/app/videos/working"
-output_dir="/app/videos/output"
-segment_dir="/app/videos/segments"
-encoded_segment_dir="/app/videos/encoded-segments"
-log_dir="/app/videos/logs"
-
-# Dynamically read the first filename in the input directory
-input_path=$(find "$input_dir" -type f | head -n 1)
-if [ -z "$input_path" ]; then
-    echo "No input file found in $input_dir."
-    exit 1
+# the shared videos volume and the local scratch volume, as mounted by
+# start.sh. both can be pointed elsewhere to run the script outside the
+# container, see test/distributed.sh.
+videos_dir="${VIDEOS_DIR:-/app/videos}"
+scratch_root="${SCRATCH_DIR:-/app/scratch}"
+input_dir="$videos_dir/input"
+output_dir="$videos_dir/output"
+log_dir="$videos_dir/logs"
+cache_dir="$videos_dir/cache"
+crf_cache_dir="$cache_dir/crf"
+probe_cache_dir="$cache_dir/probe"
+scene_cache_dir="$cache_dir/scenes"
+priority_file="$videos_dir/priority.txt"
+queue_dir="$videos_dir/queue"
+idle_dir="$queue_dir/idle"
+lease_dir="$queue_dir/leases"
+memory_ledger="$queue_dir/memory-$HOSTNAME"
+scratch_ledger="$queue_dir/scratch-$HOSTNAME"
+
+# identifies this run in the journal so workers only pick up ready titles. the
+# host name and a random suffix keep coordinators that start in the same
+# second apart, $$ is 1 in every container.
+run_id="$(date -u +%Y%m%dT%H%M%SZ)-$HOSTNAME-$(od -An -N4 -tx4 /dev/urandom | tr -d ' ')"
+run_start=$EPOCHSECONDS
+
+# queue order for queue mode: fifo, shortest or priority
+queue_order="${QUEUE_ORDER:-fifo}"
+
+# daemon mode: a copied file is ready once <file>.done exists or its size and
+# mtime have not changed for stable_seconds. the input directory is rescanned
+# at least every poll_interval seconds, also where inotify is unavailable.
+stable_seconds="${STABLE_SECONDS:-60}"
+poll_interval="${POLL_INTERVAL:-300}"
+
+# distributed encoding: publish titles for "encode.sh worker" nodes sharing
+# the videos volume, optionally without encoding on this node
+distributed="${DISTRIBUTED:-0}"
+local_encode="${LOCAL_ENCODE:-1}"
+# workers refresh their segment claims and coordinators their title leases,
+# stale claims and leases are released for others
+claim_heartbeat="${CLAIM_HEARTBEAT:-60}"
+claim_timeout="${CLAIM_TIMEOUT:-300}"
+
+# scratch tiers for the intermediate files of a title, fastest first. each
+# kind of file goes to the first tier with room for it, the videos volume is
+# the last resort. source segments share their tier with the working files
+# of the crf search, and stay on the shared videos volume for worker nodes
+# when encoding is distributed.
+segment_tiers="$scratch_root $videos_dir"
+if [ "$distributed" -eq 1 ]; then
+    segment_tiers="$videos_dir"
+fi
+declare -A scratch_tiers=(
+    [segments]="${SEGMENT_SCRATCH:-$segment_tiers}"
+    [encoded]="${ENCODED_SCRATCH:-$segment_tiers}"
+    [audio]="${AUDIO_SCRATCH:-$scratch_root $videos_dir}"
+    [mux]="${MUX_SCRATCH:-$scratch_root $videos_dir}"
+)
+# encoded segments are cached next to the encoded segments of the titles, so
+# they are hard linked rather than copied. segments encoded on another
+# filesystem are not cached.
+if [ "$distributed" -eq 1 ]; then
+    segment_cache_dir="${SEGMENT_CACHE_DIR:-$cache_dir/segments}"
+else
+    segment_cache_dir="${SEGMENT_CACHE_DIR:-$scratch_root/cache/segments}"
 fi
+# size of the encoded video relative to the source video, for the estimate of
+# the scratch space of a title
+encoded_ratio="${ENCODED_RATIO:-0.6}"
+
+# parallelism (0 = derive from the host core count and segment count)
+encode_jobs_setting="${ENCODE_JOBS:-0}"
+svt_threads_setting="${SVT_THREADS:-0}"
+min_threads_per_job="${MIN_THREADS_PER_JOB:-4}"
+# segment jobs only start while the memory they are expected to need fits
+# into the memory limit of the host or container, less this share
+memory_reserve="${MEMORY_RESERVE:-0.1}"
+# expected peak memory in KiB per megapixel of a job before any segment of
+# that resolution has been measured
+job_memory_per_megapixel="${JOB_MEMORY_PER_MEGAPIXEL:-786432}"
+
+# crop black bars found by cropdetect at this many points across the input
+# (0 = encode the full frame)
+crop_samples="${CROP_SAMPLES:-12}"
 
-# Extract the base filename without the directory and extension
-vid_file=$(basename "$input_path" .mkv)
+# segmentation (scene = cut on scene changes, fixed = every target seconds)
+segment_mode="${SEGMENT_MODE:-scene}"
+scene_threshold="${SCENE_THRESHOLD:-0.3}"
+segment_min_duration="${SEGMENT_MIN_DURATION:-60}"
+segment_target_duration="${SEGMENT_TARGET_DURATION:-120}"
+segment_max_duration="${SEGMENT_MAX_DURATION:-180}"
+# once no segment is left to claim, split segments into pieces of at least
+# this many seconds for idle workers
+split_min_duration="${SPLIT_MIN_DURATION:-20}"
+# hand segments to the encoders as soon as each one is closed and delete
+# source segments once their encode is verified. titles that only fit their
+# scratch tiers this way are streamed regardless.
+streaming_setting="${STREAMING:-1}"
 
-num_audio_tracks=$(ffprobe \
-    -v error \
-    -select_streams a \
-    -show_entries stream=index \
-    -of csv=p=0 \
-    "$input_path" \
-    | wc -l)
+# seconds between samples of the memory of measured commands
+metrics_interval="${METRICS_INTERVAL:-2}"
+page_size=$(getconf PAGESIZE 2> /dev/null || echo 4096)
+
+# svt-av1 preset. with a deadline (anything date -d understands, e.g. 07:00)
+# the preset is chosen from the measured throughput instead: the slowest one
+# between min_preset and max_preset that still finishes the run in time
+preset_setting="${PRESET:-4}"
+deadline="${DEADLINE:-}"
+min_preset="${MIN_PRESET:-2}"
+max_preset="${MAX_PRESET:-12}"
+# share of the time left kept in reserve for audio, remux and estimate errors
+deadline_margin="${DEADLINE_MARGIN:-0.1}"
+
+# crf search: the highest crf between min_crf and max_crf whose samples reach
+# min_vmaf, probing crf_search_jobs candidate crfs at a time
+min_vmaf="${MIN_VMAF:-93}"
+vmaf_options="${VMAF_OPTIONS:-n_subsample=4:pool=harmonic_mean}"
+min_crf="${MIN_CRF:-10}"
+max_crf="${MAX_CRF:-55}"
+crf_samples="${CRF_SAMPLES:-3}"
+crf_sample_duration="${CRF_SAMPLE_DURATION:-20}"
+crf_search_jobs="${CRF_SEARCH_JOBS:-3}"
+# samples are decoded once into raw frames in this directory (memory backed
+# by default), as long as they fit into sample_buffer_size bytes. the rest go
+# next to the samples, up to sample_spill_size bytes per search, when those
+# are on a local scratch tier rather than the videos volume.
+sample_buffer_dir="${SAMPLE_BUFFER_DIR:-/dev/shm}"
+sample_buffer_size="${SAMPLE_BUFFER_SIZE:-4294967296}"
+sample_spill_size="${SAMPLE_SPILL_SIZE:-17179869184}"
+
+# crf search results cached by segment content, evicted beyond this many bytes
+crf_cache_max_size="${CRF_CACHE_MAX_SIZE:-10485760}"
+# encoded segments cached by the same key, so re-runs with unchanged video
+# settings only repeat the other stages
+segment_cache_max_size="${SEGMENT_CACHE_MAX_SIZE:-107374182400}"
 
 # functions
-segment_video() {
+# point the per-title variables at an input file
+load_title() {
+    input_path=$1
+    # Extract the base filename without the directory and extension
+    vid_file=$(basename "$input_path" .mkv)
+    title_log_dir="$log_dir/$vid_file"
+    # job journal, one JSON record per line, used to resume interrupted runs
+    journal_file="$log_dir/$vid_file.journal"
+    # scratch directories on the tiers chosen for the title
+    segment_dir="$(scratch_tier segments)/segments/$vid_file"
+    working_dir="$(scratch_tier segments)/working/$vid_file"
+    encoded_segment_dir="$(scratch_tier encoded)/encoded-segments/$vid_file"
+    audio_dir="$(scratch_tier audio)/audio/$vid_file"
+    mux_dir="$(scratch_tier mux)/mux/$vid_file"
+    claim_dir="$encoded_segment_dir/.claims-$run_id"
+    streaming=$(journal_last '"stage":"scratch",' streaming)
+    streaming=${streaming:-$streaming_setting}
+    spill_samples=$(journal_last '"stage":"scratch",' spill)
+    spill_samples=${spill_samples:-0}
+    # resource usage of every measured command, one file per host
+    metrics_file="$title_log_dir/metrics-$HOSTNAME.jsonl"
+    report_file="$log_dir/$vid_file.report"
+}
+
+# probe the input once (streams, chapters and format) and load the result
+# into the media array. results are cached by path, size and mtime.
+#   media[format.duration]                  source duration in seconds
+#   media[audio.count], media[audio.0] ...  stream count and global index by type
+#   media[chapters.count]                   number of chapters
+# see media_stream for per-stream fields
+probe_media() {
+    local key probe_file field value type n
+    key=$(printf '%s %s' "$input_path" "$(source_id)" | sha256sum | cut -d ' ' -f 1)
+    probe_file="$probe_cache_dir/$key"
+    if [ ! -f "$probe_file" ]; then
+        ffprobe \
+            -v error \
+            -show_streams \
+            -show_chapters \
+            -show_format \
+            -of flat \
+            "$input_path" \
+            > "$probe_file.$$" \
+            || return 1
+        mv "$probe_file.$$" "$probe_file"
+    fi
+
+    declare -gA media=()
+    local -A type_count=([video]=0 [audio]=0 [subtitle]=0 [attachment]=0 [data]=0)
+    local chapters=0
+    while IFS='=' read -r field value; do
+        value=${value#\"}
+        value=${value%\"}
+        media[$field]=$value
+        case "$field" in
+            streams.stream.*.codec_type)
+                n=${field#streams.stream.}
+                n=${n%%.*}
+                type=$value
+                media[$type.${type_count[$type]:-0}]=$n
+                type_count[$type]=$((${type_count[$type]:-0} + 1))
+                ;;
+            chapters.chapter.*.id)
+                chapters=$((chapters + 1))
+                ;;
+        esac
+    done < "$probe_file"
+    for type in "${!type_count[@]}"; do
+        media[$type.count]=${type_count[$type]}
+    done
+    media[chapters.count]=$chapters
+    num_audio_tracks=${media[audio.count]}
+}
+
+# print a field of the n-th stream of a type, e.g. media_stream audio 0 channels
+media_stream() {
+    local type=$1
+    local n=$2
+    local field=$3
+    echo "${media[streams.stream.${media[$type.$n]}.$field]}"
+}
+
+# ffmpeg disposition of the n-th stream of a type, e.g. default+forced, or 0
+media_disposition() {
+    local type=$1
+    local n=$2
+    local prefix="streams.stream.${media[$type.$n]}.disposition."
+    local field
+    local flags=()
+    for field in "${!media[@]}"; do
+        if [[ "$field" == "$prefix"* ]] && [ "${media[$field]}" = "1" ]; then
+            flags+=("${field#"$prefix"}")
+        fi
+    done
+    local IFS='+'
+    echo "${flags[*]:-0}"
+}
+
+# append a record to the job journal, e.g. journal stage=segment status=done
+journal() {
+    local field
+    local line="{\"time\":\"$(date -u +%FT%TZ)\""
+    for field in "$@"; do
+        line+=",\"${field%%=*}\":\"${field#*=}\""
+    done
+    echo "$line}" >> "$journal_file"
+}
+
+# print a field of the last journal record containing the given text
+journal_last() {
+    local filter=$1
+    local field=$2
+    if [ ! -f "$journal_file" ]; then
+        return
+    fi
+    grep -F "$filter" "$journal_file" \
+        | tail -n 1 \
+        | sed -n "s/.*\"$field\":\"\([^\"]*\)\".*/\1/p"
+}
+
+stage_done() {
+    [ "$(journal_last "\"stage\":\"$1\"," status)" = "done" ]
+}
+
+# a journal entry is only trusted while its output still has the same hash
+output_done() {
+    local filter=$1
+    local file=$2
+    local hash
+    [ -f "$file" ] || return 1
+    [ "$(journal_last "$filter" status)" = "done" ] || return 1
+    hash=$(journal_last "$filter" sha256)
+    [ "$hash" = "$(sha256sum "$file" | cut -d ' ' -f 1)" ]
+}
+
+# scratch tier of a kind of intermediate file, as journaled for the loaded
+# title or else the first tier of the kind
+scratch_tier() {
+    local kind=$1
+    local tier
+    tier=$(journal_last '"stage":"scratch",' "$kind")
+    echo "${tier:-${scratch_tiers[$kind]%% *}}"
+}
+
+# estimate the scratch space of the loaded title from its probe, in bytes:
+# source segments, encoded segments, audio copies and encodes, the encoded
+# audio alone, the muxed output, and the samples and probe encodes of the
+# concurrent crf searches and the decoded samples they may spill. the video
+# is what the audio leaves of the source, audio tracks without a known
+# bitrate count as 1536 kb/s.
+scratch_sizes() {
+    local i rate jobs
+    local rates=()
+    local channels=()
+    jobs=$(plan_parallelism 0 > /dev/null; echo "$encode_jobs")
+    for ((i=0; i<num_audio_tracks; i++)); do
+        rate=$(media_stream audio "$i" bit_rate)
+        [[ "$rate" =~ ^[0-9]+$ ]] || rate=$(media_stream audio "$i" tags.BPS)
+        [[ "$rate" =~ ^[0-9]+$ ]] || rate=1536000
+        rates+=("$rate")
+        channels+=("$(media_stream audio "$i" channels)")
+    done
+    awk \
+        -v size="${media[format.size]:-$(stat -c '%s' "$input_path")}" \
+        -v duration="${media[format.duration]:-0}" \
+        -v ratio="$encoded_ratio" \
+        -v rates="${rates[*]}" \
+        -v channels="${channels[*]}" \
+        -v jobs="$jobs" \
+        -v samples="$crf_samples" \
+        -v seconds="$crf_sample_duration" \
+        -v probes="$crf_search_jobs" \
+        -v pixels="$(media_stream video 0 width) $(media_stream video 0 height)" \
+        -v fps="$(media_stream video 0 avg_frame_rate)" \
+        -v spill_size="$sample_spill_size" \
+        'BEGIN {
+            n = split(rates, rate, " ")
+            split(channels, channel, " ")
+            for (i = 1; i <= n; i++) {
+                copies += rate[i] * duration / 8
+                # the opus bitrate of encode_audio_track
+                opus += (channel[i] ? channel[i] : 2) * 64000 * duration / 8
+            }
+            video = size > copies ? size - copies : size
+            encoded = video * ratio
+            # samples of a search and one encode per probe at a time
+            sampled = duration > 0 ? video / duration * samples * seconds : 0
+            search = jobs * (sampled + probes * sampled / samples * ratio)
+            # 10 bit 4:2:0 frames like buffer_samples
+            split(pixels, frame, " ")
+            split(fps, frames, "/")
+            decoded = frame[1] * frame[2] * 3 * frames[1] / (frames[2] ? frames[2] : 1) * samples * seconds
+            spill = jobs * (decoded < spill_size ? decoded : spill_size)
+            printf "%.0f %.0f %.0f %.0f %.0f %.0f %.0f\n", video, encoded, copies + opus, opus, encoded + opus, search, spill
+        }'
+}
+
+# peak bytes per device of the loaded title with the kinds placed so far in
+# scratch_device: the larger of segmenting and encoding video and audio, and
+# of muxing and copying the output off the scratch tier. with streaming the
+# source segments give way to their encodes. the crf searches work next to
+# the source segments, and spill decoded samples there unless that is the
+# videos volume.
+scratch_peaks() {
+    local mode=$1
+    local spill=$2
+    local kind device
+    local -A encoding=()
+    local -A muxing=()
+    for kind in "${!scratch_device[@]}"; do
+        device=${scratch_device[$kind]}
+        case "$kind" in
+            segments)
+                encoding[$device]=$((${encoding[$device]:-0} + scratch_size[segments] + scratch_size[search]))
+                if [ "$spill" -eq 1 ] && [ "$device" != "$videos_device" ]; then
+                    encoding[$device]=$((${encoding[$device]:-0} + scratch_size[spill]))
+                fi
+                if [ "$mode" -ne 1 ]; then
+                    muxing[$device]=$((${muxing[$device]:-0} + scratch_size[segments]))
+                fi
+                ;;
+            encoded)
+                if [ "$mode" -ne 1 ] || [ "$device" != "${scratch_device[segments]}" ]; then
+                    encoding[$device]=$((${encoding[$device]:-0} + scratch_size[encoded]))
+                fi
+                muxing[$device]=$((${muxing[$device]:-0} + scratch_size[encoded]))
+                ;;
+            audio)
+                encoding[$device]=$((${encoding[$device]:-0} + scratch_size[audio]))
+                muxing[$device]=$((${muxing[$device]:-0} + scratch_size[opus]))
+                ;;
+            mux)
+                muxing[$device]=$((${muxing[$device]:-0} + scratch_size[mux]))
+                if [ "$device" != "$output_device" ]; then
+                    muxing[$output_device]=$((${muxing[$output_device]:-0} + scratch_size[mux]))
+                fi
+                ;;
+        esac
+    done
+    for device in "${!encoding[@]}" "${!muxing[@]}"; do
+        if [ "${encoding[$device]:-0}" -gt "${muxing[$device]:-0}" ]; then
+            echo "$device ${encoding[$device]}"
+        else
+            echo "$device ${muxing[$device]}"
+        fi
+    done | sort -u
+}
+
+# true when the peaks of the kinds placed so far fit the space left on their
+# devices
+scratch_fits() {
+    local mode=$1
+    local spill=$2
+    local device peak
+    while read -r device peak; do
+        [ "$peak" -le "${scratch_avail[$device]}" ] || return 1
+    done < <(scratch_peaks "$mode" "$spill")
+}
+
+# free bytes of the device of a directory, less the space the other titles in
+# flight on this host reserved on it and have not written yet
+scratch_free() {
+    local dir=$1
+    local device used
+    local entry=()
+    local free
+    device=$(stat -c '%d' "$dir")
+    free=$(df --output=avail -B 1 "$dir" | tail -n 1)
+    # ledger fields are tab separated: pid, title, device, bytes and the
+    # directories of the title on the device
+    while IFS=$'\t' read -r -a entry; do
+        if [ "${entry[2]}" != "$device" ] \
+            || [ "${entry[1]}" = "$vid_file" ] \
+            || ! kill -0 "${entry[0]}" 2> /dev/null; then
+            continue
+        fi
+        used=$(du -bcs "${entry[@]:4}" 2> /dev/null | tail -n 1 | cut -f 1)
+        if [ "${entry[3]}" -gt "${used:-0}" ]; then
+            free=$((free - entry[3] + ${used:-0}))
+        fi
+    done < <(cat "$scratch_ledger" 2> /dev/null)
+    echo "$free"
+}
+
+# reserve the peak scratch space of the loaded title in the scratch ledger,
+# with the directories it writes on each device to account for what it used
+reserve_scratch() {
+    local device peak kind
+    local -A dirs=(
+        [$output_device]=$'\t'"$output_dir/$vid_file.partial.mkv"
+    )
+    for kind in "${!scratch_device[@]}"; do
+        case "$kind" in
+            segments) dirs[${scratch_device[$kind]}]+=$'\t'"$segment_dir"$'\t'"$working_dir" ;;
+            encoded) dirs[${scratch_device[$kind]}]+=$'\t'"$encoded_segment_dir" ;;
+            audio) dirs[${scratch_device[$kind]}]+=$'\t'"$audio_dir" ;;
+            mux) dirs[${scratch_device[$kind]}]+=$'\t'"$mux_dir" ;;
+        esac
+    done
+    (
+        flock 9
+        awk -F '\t' -v title="$vid_file" '$2 != title' "$scratch_ledger" > "$scratch_ledger.tmp" 2> /dev/null
+        while read -r device peak; do
+            printf '%s\t%s\t%s\t%s%s\n' "$$" "$vid_file" "$device" "$peak" "${dirs[$device]}"
+        done < <(scratch_peaks "$streaming" "$spill_samples") >> "$scratch_ledger.tmp"
+        mv "$scratch_ledger.tmp" "$scratch_ledger"
+    ) 9> "$scratch_ledger.lock"
+}
+
+# release the scratch reservation of the loaded title
+release_scratch() {
+    (
+        flock 9
+        awk -F '\t' -v title="$vid_file" '$2 != title' "$scratch_ledger" > "$scratch_ledger.tmp" 2> /dev/null
+        mv "$scratch_ledger.tmp" "$scratch_ledger"
+    ) 9> "$scratch_ledger.lock"
+}
+
+# choose the scratch tiers of the loaded title from the estimate of the space
+# it needs. every kind of intermediate file goes to the first tier of its list
+# where the peaks of the title still fit next to the titles in flight. when
+# nothing fits the title is streamed to save space, and refused when that
+# does not fit either. the crf searches only spill decoded samples where that
+# still fits with the tiers chosen. a resumed title keeps its tiers while its
+# directories are still there.
+choose_scratch() {
+    local kind tier chosen device mode spill
+    local modes=("$streaming_setting")
+    local record=()
+    declare -gA scratch_size=()
+    declare -gA scratch_device=()
+    declare -gA scratch_avail=()
+    read -r scratch_size[segments] scratch_size[encoded] scratch_size[audio] \
+        scratch_size[opus] scratch_size[mux] scratch_size[search] scratch_size[spill] \
+        < <(scratch_sizes)
+    output_device=$(stat -c '%d' "$output_dir")
+    videos_device=$(stat -c '%d' "$videos_dir")
+    if [ -n "$(journal_last '"stage":"scratch",' segments)" ] \
+        && [ -d "$segment_dir" ] \
+        && [ -d "$encoded_segment_dir" ] \
+        && [ -d "$audio_dir" ] \
+        && [ -d "$mux_dir" ]; then
+        for kind in segments encoded audio mux; do
+            scratch_device[$kind]=$(stat -c '%d' "$(scratch_tier "$kind")")
+        done
+        reserve_scratch
+        return
+    fi
+    scratch_avail[$output_device]=$(scratch_free "$output_dir")
+    if [ "$streaming_setting" -ne 1 ]; then
+        modes+=(1)
+    fi
+    for mode in "${modes[@]}"; do
+        record=()
+        scratch_device=()
+        for kind in segments encoded audio mux; do
+            chosen=
+            for tier in ${scratch_tiers[$kind]}; do
+                mkdir -p "$tier" 2> /dev/null || continue
+                device=$(stat -c '%d' "$tier")
+                if [ -z "${scratch_avail[$device]}" ]; then
+                    scratch_avail[$device]=$(scratch_free "$tier")
+                fi
+                scratch_device[$kind]=$device
+                if scratch_fits "$mode" 0; then
+                    chosen=$tier
+                    break
+                fi
+                unset "scratch_device[$kind]"
+                echo "Not enough space for the $kind of $vid_file on $tier"
+            done
+            if [ -z "$chosen" ]; then
+                break
+            fi
+            record+=("$kind=$chosen")
+        done
+        if [ "${#record[@]}" -eq 4 ]; then
+            spill=0
+            if [ "${scratch_device[segments]}" != "$videos_device" ]; then
+                if scratch_fits "$mode" 1; then
+                    spill=1
+                else
+                    echo "Decoding crf search samples of $vid_file for every probe to fit its scratch space"
+                fi
+            fi
+            if [ "$mode" != "$streaming_setting" ]; then
+                echo "Streaming segments of $vid_file to fit its scratch space"
+            fi
+            journal stage=scratch status=done "${record[@]}" streaming="$mode" spill="$spill"
+            load_title "$input_path"
+            reserve_scratch
+            return
+        fi
+    done
+    echo "Not enough space to encode $vid_file, estimated at" \
+        "$(printf '%s\n' "${scratch_size[segments]}" "${scratch_size[search]}" \
+            "${scratch_size[encoded]}" "${scratch_size[audio]}" "${scratch_size[mux]}" \
+            | awk '{printf "%s%.1f GiB", (NR > 1 ? ", " : ""), $1 / 1073741824}')" \
+        "for source segments, crf searches, encoded segments, audio and output." >&2
+    return 1
+}
+
+source_id() {
+    stat -c '%s-%Y' "$input_path"
+}
+
+# a title whose journal shows a finished job for the same source is done
+title_complete() {
+    [ "$(journal_last '"stage":"job",' source)" = "$(source_id)" ] && stage_done job
+}
+
+# resume the journal of an interrupted run of the same source, or start over
+start_journal() {
+    local source
+    source=$(source_id)
+    if [ -f "$journal_file" ]; then
+        if [ "$(journal_last '"stage":"job",' source)" = "$source" ] \
+            && ! stage_done job; then
+            echo "Resuming interrupted job for $vid_file"
+            return
+        fi
+        mv "$journal_file" "$journal_file.$(date -u +%Y%m%dT%H%M%SZ)"
+    fi
+    rm -f "$title_log_dir"/metrics-*.jsonl
+    rm -rf "${segment_dir:?}"/* "${encoded_segment_dir:?}"/* "${working_dir:?}"/* \
+        "${audio_dir:?}"/* "${mux_dir:?}"/*
+    journal stage=job status=started source="$source"
+}
+
+# print a process and all of its descendants
+process_tree() {
+    local pid=$1
+    local child
+    echo "$pid"
+    for child in $(cat /proc/"$pid"/task/*/children 2> /dev/null); do
+        process_tree "$child"
+    done
+}
+
+# sample the memory of a process tree until it exits. writes the peak total
+# rss in KiB to stats_file.
+sample_process_tree() {
+    local root=$1
+    local stats_file=$2
+    local peak=0
+    local pid rss pages
+    while kill -0 "$root" 2> /dev/null; do
+        rss=0
+        for pid in $(process_tree "$root"); do
+            read -r _ pages _ 2> /dev/null < /proc/"$pid"/statm || continue
+            rss=$((rss + pages))
+        done
+        if [ "$rss" -gt "$peak" ]; then
+            peak=$rss
+            echo "$((peak * page_size / 1024))" > "$stats_file.tmp"
+            mv "$stats_file.tmp" "$stats_file"
+        fi
+        sleep "$metrics_interval"
+    done
+}
+
+# set io_read and io_written to the bytes this shell and the children it
+# reaped read from and wrote to storage. has to run in the measured shell
+# itself, the kernel adds the io of a child to its parent when it is reaped.
+read_io() {
+    local key value
+    io_read=0
+    io_written=0
+    while read -r key value; do
+        case "$key" in
+            read_bytes:) io_read=$value ;;
+            write_bytes:) io_written=$value ;;
+        esac
+    done 2> /dev/null < /proc/"$BASHPID"/io
+}
+
+# run a command and append its wall time, cpu time, peak rss and io to the
+# metrics log, e.g. measure stage=remux -- remux_tracks
+measure() {
+    local fields=()
+    while [ "$1" != "--" ]; do
+        fields+=("$1")
+        shift
+    done
+    shift
+    (
+        local start end status pid sampler_pid stats_file cpu field
+        local io_read io_written read_bytes written_bytes
+        local peak_rss=0
+        stats_file=$(mktemp)
+        read_io
+        read_bytes=$io_read
+        written_bytes=$io_written
+        start=$EPOCHREALTIME
+        "$@" &
+        pid=$!
+        sample_process_tree "$pid" "$stats_file" &
+        sampler_pid=$!
+        wait "$pid"
+        status=$?
+        end=$EPOCHREALTIME
+        kill "$sampler_pid" 2> /dev/null
+        wait "$sampler_pid" 2> /dev/null
+        read_io
+        read_bytes=$((io_read - read_bytes))
+        written_bytes=$((io_written - written_bytes))
+        if [ -s "$stats_file" ]; then
+            read -r peak_rss < "$stats_file"
+        fi
+        # user and system cpu time of all reaped children, e.g. "1m2.5s 0m3.1s".
+        # times has to run in this shell, a pipeline would report its own children
+        times > "$stats_file"
+        cpu=$(tail -n 1 "$stats_file" | awk '{
+            for (i = 1; i <= 2; i++) {
+                split($i, t, "m")
+                sub(/s$/, "", t[2])
+                printf "%.3f ", t[1] * 60 + t[2]
+            }
+        }')
+        rm -f "$stats_file"
+        local line="{\"host\":\"$HOSTNAME\""
+        for field in "${fields[@]}"; do
+            line+=",\"${field%%=*}\":\"${field#*=}\""
+        done
+        line+=",\"status\":$status,\"start\":$start"
+        line+=",\"wall\":$(awk -v s="$start" -v e="$end" 'BEGIN {printf "%.3f", e - s}')"
+        line+=",\"user\":${cpu%% *},\"system\":$(echo "$cpu" | cut -d ' ' -f 2)"
+        line+=",\"peak_rss_kb\":$peak_rss,\"read_bytes\":$read_bytes"
+        line+=",\"written_bytes\":$written_bytes}"
+        echo "$line" >> "$metrics_file"
+        exit "$status"
+    )
+}
+
+# duration in seconds of a closed segment, from the segment list
+segment_duration() {
+    awk -F ',' -v name="$1" '$1 == name {printf "%.3f", $3 - $2}' \
+        "$segment_dir/segments.csv" 2> /dev/null
+}
+
+# detect black bars on a few frames at points spread over the input. prints
+# the bounding box of the picture found at all points as w:h:x:y, so a dark
+# scene cannot crop away picture visible elsewhere, or nothing if there are
+# no bars to crop.
+detect_crop() {
+    local duration=${media[format.duration]}
+    local i
+    for ((i=1; i<=crop_samples; i++)); do
+        ffmpeg \
+            -hide_banner \
+            -nostats \
+            -ss "$(awk -v duration="$duration" -v i="$i" -v n="$crop_samples" \
+                'BEGIN {printf "%.3f", duration * i / (n + 1)}')" \
+            -i "$input_path" \
+            -map 0:v:0 \
+            -frames:v 10 \
+            -vf cropdetect=round=2 \
+            -f null \
+            - 2>&1 \
+            | sed -n 's/.*crop=\([0-9:-]*\).*/\1/p' \
+            | tail -n 1
+    done | awk -F ':' \
+        -v width="$(media_stream video 0 width)" \
+        -v height="$(media_stream video 0 height)" '
+        # black frames report an empty or negative area
+        $1 > 0 && $2 > 0 {
+            if (!n++ || $3 < left) left = $3
+            if (n == 1 || $4 < top) top = $4
+            if (n == 1 || $3 + $1 > right) right = $3 + $1
+            if (n == 1 || $4 + $2 > bottom) bottom = $4 + $2
+        }
+        END {
+            if (!n) exit
+            left = left < 0 ? 0 : left - left % 2
+            top = top < 0 ? 0 : top - top % 2
+            if (right > width) right = width
+            if (bottom > height) bottom = height
+            w = right - left
+            h = bottom - top
+            w -= w % 2
+            h -= h % 2
+            if (w < width || h < height) printf "%d:%d:%d:%d\n", w, h, left, top
+        }'
+}
+
+# print "pts_time iskey" for every scene change, using a low-res decode
+detect_scenes() {
     ffmpeg \
+        -hide_banner \
+        -nostats \
+        -i "$input_path" \
+        -map 0:v:0 \
+        -vf "scale=-2:144,select='gt(scene,$scene_threshold)',showinfo" \
+        -f null \
+        - 2>&1 \
+        | sed -n 's/.*Parsed_showinfo.* pts_time:\([0-9.]*\).* iskey:\([01]\).*/\1 \2/p'
+}
+
+# choose segment boundaries from scene changes so that every segment lasts
+# between the min and max duration, as close to the target as possible.
+# prints comma separated cut times for the segment muxer.
+plan_segment_times() {
+    local duration=$1
+    awk \
+        -v total="$duration" \
+        -v min="$segment_min_duration" \
+        -v target="$segment_target_duration" \
+        -v max="$segment_max_duration" '
+        { time[NR] = $1; key[NR] = $2 }
+        END {
+            last = 0
+            out = ""
+            while (total - last > max) {
+                lo = last + min
+                hi = last + max
+                if (hi > total - min) hi = total - min
+                want = last + target
+                best = -1
+                for (i = 1; i <= NR; i++) {
+                    if (time[i] < lo || time[i] > hi) continue
+                    # prefer scene changes that already start on a keyframe
+                    score = (time[i] - want) ^ 2 + (key[i] ? 0 : 25)
+                    if (best < 0 || score < best_score) {
+                        best = time[i]
+                        best_score = score
+                    }
+                }
+                # no usable scene change, cut at the next keyframe after target
+                if (best < 0) best = want
+                out = out (out == "" ? "" : ",") sprintf("%.3f", best)
+                last = best
+            }
+            print out
+        }'
+}
+
+segment_video() {
+    local split_args=(-segment_time "$segment_target_duration")
+
+    if [ "$segment_mode" = "scene" ]; then
+        local duration=${media[format.duration]}
+        local segment_times scenes_file
+        scenes_file="$scene_cache_dir/$(printf '%s %s %s' "$input_path" "$(source_id)" "$scene_threshold" \
+            | sha256sum | cut -d ' ' -f 1)"
+        if [ -f "$scenes_file" ]; then
+            echo "Using cached scene changes"
+            cp "$scenes_file" "$title_log_dir/scenes.txt"
+        else
+            echo "Detecting scene changes"
+            measure stage=scenes -- detect_scenes > "$title_log_dir/scenes.txt"
+            cp "$title_log_dir/scenes.txt" "$scenes_file.$$"
+            mv "$scenes_file.$$" "$scenes_file"
+        fi
+        segment_times=$(plan_segment_times "$duration" < "$title_log_dir/scenes.txt")
+        if [ -n "$segment_times" ]; then
+            echo "$segment_times" | tr ',' '\n' > "$title_log_dir/segment-times.txt"
+            split_args=(-segment_times "$segment_times")
+        fi
+    fi
+
+    # copy the audio tracks out in the same pass to avoid reading the source twice
+    local audio_args
+    mapfile -t audio_args < <(audio_copy_args)
+
+    measure stage=segment -- ffmpeg \
+        -y \
         -i "$input_path" \
         -c:v copy \
         -an \
         -map 0 \
-        -segment_time 00:02:00 \
+        "${split_args[@]}" \
         -f segment \
+        -segment_list "$segment_dir/segments.csv" \
+        -segment_list_type csv \
         -reset_timestamps 1 \
-        "$segment_dir"/%04d.mkv
+        "$segment_dir"/%04d.mkv \
+        "${audio_args[@]}"
 }
 
-encode_segments() {
-    cd "$segment_dir"
-    for f in *.mkv; do
-        ab-av1 \
-            auto-encode \
-            -e libsvtav1 \
-            --svt tune=0 \
-            --keyint 5s \
-            --min-vmaf 93 \
-            --preset 4 \
-            --vmaf n_subsample=4:pool=harmonic_mean \
-            --samples 3 \
-            --enc fps_mode=passthrough \
-            --input "$f" \
-            --output "$encoded_segment_dir"/"$(basename "$f")"
+# list the CPUs this process may run on, one per line
+allowed_cpus() {
+    local list range ranges
+    list=$(awk '/^Cpus_allowed_list:/ {print $2}' /proc/self/status)
+    IFS=',' read -ra ranges <<< "$list"
+    for range in "${ranges[@]}"; do
+        if [[ "$range" == *-* ]]; then
+            seq "${range%-*}" "${range#*-}"
+        else
+            echo "$range"
+        fi
     done
 }
 
-concatenate_segments() {
-    ffmpeg \
-        -f concat \
-        -safe 0 \
-        -i <(for f in "$encoded_segment_dir"/*.mkv; do echo "file '$f'"; done) \
-        -c copy "$working_dir/$vid_file"
+# directories of the cgroup of this process, from its own up to the root of
+# the hierarchy. with a controller name the v1 hierarchy of that controller,
+# otherwise the v2 hierarchy.
+cgroup_dirs() {
+    local controller=$1
+    local path mount
+    if [ -z "$controller" ]; then
+        mount=/sys/fs/cgroup
+        if [ ! -f "$mount/cgroup.controllers" ]; then
+            # hybrid hosts mount v2 next to the v1 controllers
+            mount=/sys/fs/cgroup/unified
+        fi
+        path=$(awk -F ':' '$1 == "0" {print $3}' /proc/self/cgroup 2> /dev/null)
+    else
+        mount=/sys/fs/cgroup/$controller
+        path=$(awk -F ':' -v controller="$controller" '{
+            n = split($2, names, ",")
+            for (i = 1; i <= n; i++) if (names[i] == controller) print $3
+        }' /proc/self/cgroup 2> /dev/null)
+    fi
+    if [ -z "$path" ] || [ ! -d "$mount" ]; then
+        return
+    fi
+    # without a cgroup namespace the path is the one seen from the host and
+    # only the root of the hierarchy is mounted in the container
+    if [ ! -d "$mount$path" ]; then
+        path=/
+    fi
+    while true; do
+        echo "$mount${path%/}"
+        if [ "$path" = "/" ]; then
+            break
+        fi
+        path=$(dirname "$path")
+    done
 }
 
-encode_audio() {
-    for ((i=0; i<num_audio_tracks; i++)); do
-        num_audio_channels=$(ffprobe \
+# whole cpus allowed by the cgroup cpu quota (v2 cpu.max or v1 cfs quota) of
+# this process and its ancestors, empty without a quota
+cpu_quota() {
+    local dir quota period
+    local cpus=
+    while read -r dir; do
+        if read -r quota period < "$dir/cpu.max" && [ "$quota" != "max" ]; then
+            if [ -z "$cpus" ] || [ $((quota / period)) -lt "$cpus" ]; then
+                cpus=$((quota / period))
+            fi
+        fi
+    done 2> /dev/null < <(cgroup_dirs)
+    while read -r dir; do
+        if read -r quota < "$dir/cpu.cfs_quota_us" \
+            && read -r period < "$dir/cpu.cfs_period_us" \
+            && [ "$quota" -gt 0 ]; then
+            if [ -z "$cpus" ] || [ $((quota / period)) -lt "$cpus" ]; then
+                cpus=$((quota / period))
+            fi
+        fi
+    done 2> /dev/null < <(cgroup_dirs cpu)
+    if [ -n "$cpus" ] && [ "$cpus" -lt 1 ]; then
+        cpus=1
+    fi
+    echo "$cpus"
+}
+
+# cores this process can use without being throttled: the cpus of its
+# affinity mask and cpuset, limited by the cgroup cpu quota
+available_cores() {
+    local cores quota
+    cores=$(allowed_cpus | wc -l)
+    quota=$(cpu_quota)
+    if [ -n "$quota" ] && [ "$quota" -lt "$cores" ]; then
+        cores=$quota
+    fi
+    echo "$cores"
+}
+
+# choose the number of concurrent encodes and SVT-AV1 threads per encode,
+# num_segments of 0 leaves the number of jobs uncapped
+plan_parallelism() {
+    local num_segments=$1
+    local cores
+    cores=$(available_cores)
+
+    encode_jobs=$encode_jobs_setting
+    if [ "$encode_jobs" -le 0 ]; then
+        encode_jobs=$((cores / min_threads_per_job))
+    fi
+    if [ "$num_segments" -gt 0 ] && [ "$encode_jobs" -gt "$num_segments" ]; then
+        encode_jobs=$num_segments
+    fi
+    if [ "$encode_jobs" -lt 1 ]; then
+        encode_jobs=1
+    fi
+    svt_threads=$svt_threads_setting
+    if [ "$svt_threads" -le 0 ]; then
+        svt_threads=$((cores / encode_jobs))
+    fi
+    if [ "$svt_threads" -lt 1 ]; then
+        svt_threads=1
+    fi
+    echo "Encoding with $encode_jobs jobs of $svt_threads threads on $cores cores"
+}
+
+# cpu list (taskset format) for a worker slot, empty if slots would overlap
+slot_cpus() {
+    local slot=$1
+    local cpus
+    mapfile -t cpus < <(allowed_cpus)
+    if ! command -v taskset > /dev/null \
+        || [ $((encode_jobs * svt_threads)) -gt "${#cpus[@]}" ]; then
+        return
+    fi
+    local first=$((slot * svt_threads))
+    local selected=("${cpus[@]:first:svt_threads}")
+    local IFS=','
+    echo "${selected[*]}"
+}
+
+# memory limit in KiB: the memory of the host, limited by the cgroup memory
+# limits (v2 memory.max or v1 memory.limit_in_bytes) of this process and its
+# ancestors
+memory_limit() {
+    local dir limit
+    local total
+    total=$(awk '/^MemTotal:/ {print $2}' /proc/meminfo)
+    while read -r dir; do
+        if read -r limit < "$dir/memory.max" \
+            && [ "$limit" != "max" ] \
+            && [ $((limit / 1024)) -lt "$total" ]; then
+            total=$((limit / 1024))
+        fi
+    done 2> /dev/null < <(cgroup_dirs)
+    while read -r dir; do
+        if read -r limit < "$dir/memory.limit_in_bytes" \
+            && [ $((limit / 1024)) -lt "$total" ]; then
+            total=$((limit / 1024))
+        fi
+    done 2> /dev/null < <(cgroup_dirs memory)
+    echo "$total"
+}
+
+# memory in KiB available now: the available memory of the host, or what is
+# left below the cgroup memory limit of this process or an ancestor where
+# that is less. inactive page cache is reclaimed before the limit is hit.
+memory_available() {
+    local dir limit usage inactive
+    local available
+    available=$(awk '/^MemAvailable:/ {print $2}' /proc/meminfo)
+    while read -r dir; do
+        if read -r limit < "$dir/memory.max" \
+            && [ "$limit" != "max" ] \
+            && read -r usage < "$dir/memory.current"; then
+            inactive=$(awk '$1 == "inactive_file" {print $2}' "$dir/memory.stat")
+            if [ $(((limit - usage + ${inactive:-0}) / 1024)) -lt "$available" ]; then
+                available=$(((limit - usage + ${inactive:-0}) / 1024))
+            fi
+        fi
+    done 2> /dev/null < <(cgroup_dirs)
+    while read -r dir; do
+        if read -r limit < "$dir/memory.limit_in_bytes" \
+            && read -r usage < "$dir/memory.usage_in_bytes"; then
+            inactive=$(awk '$1 == "total_inactive_file" {print $2}' "$dir/memory.stat")
+            if [ $(((limit - usage + ${inactive:-0}) / 1024)) -lt "$available" ]; then
+                available=$(((limit - usage + ${inactive:-0}) / 1024))
+            fi
+        fi
+    done 2> /dev/null < <(cgroup_dirs memory)
+    if [ "$available" -lt 0 ]; then
+        available=0
+    fi
+    echo "$available"
+}
+
+# resolution a segment is encoded at, e.g. 1920x800 after cropping
+segment_resolution() {
+    local f=$1
+    local crop
+    crop=$(journal_last '"stage":"crop",' crop)
+    if [ -n "$crop" ]; then
+        echo "$crop" | awk -F ':' '{print $1 "x" $2}'
+        return
+    fi
+    ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of csv=s=x:p=0 "$f"
+}
+
+# expected peak memory in KiB of a segment job at a resolution: the largest
+# peak measured at that resolution, or the largest peak per pixel measured at
+# other resolutions scaled to it
+job_memory() {
+    local resolution=$1
+    cat "$log_dir"/*/metrics-*.jsonl 2> /dev/null | awk \
+        -v resolution="$resolution" \
+        -v per_megapixel="$job_memory_per_megapixel" '
+        function field(name,    value) {
+            if (!match($0, "\"" name "\":[^,}]*")) return ""
+            value = substr($0, RSTART + length(name) + 3, RLENGTH - length(name) - 3)
+            gsub(/"/, "", value)
+            return value
+        }
+        {
+            stage = field("stage")
+            if (stage != "crf-search" && stage != "encode") next
+            split(field("resolution"), size, "x")
+            if (size[1] * size[2] <= 0) next
+            rss = field("peak_rss_kb") + 0
+            if (field("resolution") == resolution && rss > peak) peak = rss
+            if (rss / (size[1] * size[2]) > per_pixel) per_pixel = rss / (size[1] * size[2])
+        }
+        END {
+            split(resolution, size, "x")
+            if (!peak && per_pixel) peak = per_pixel * size[1] * size[2]
+            if (!peak) peak = per_megapixel * size[1] * size[2] / 1000000
+            printf "%d\n", peak
+        }'
+}
+
+# KiB of memory the jobs of this host may reserve in total, given the KiB
+# they reserved so far. memory in use beyond those reservations is taken by
+# something the ledger does not cover, like the segmentation and audio
+# encodes of the coordinator or other containers, and is left to it.
+memory_budget() {
+    local reserved=$1
+    awk \
+        -v limit="$(memory_limit)" \
+        -v available="$(memory_available)" \
+        -v reserved="$reserved" \
+        -v reserve="$memory_reserve" \
+        'BEGIN {
+            outside = limit - available - reserved
+            printf "%d", limit * (1 - reserve) - (outside > 0 ? outside : 0)
+        }'
+}
+
+# wait until a job expected to need the given KiB fits next to the jobs
+# already admitted on this host, then reserve it in the memory ledger. a job
+# is always admitted when no other job runs, so one large encode still runs.
+admit_job() {
+    local slot=$1
+    local need=$2
+    local owner=$BASHPID
+    local waiting=0
+    until (
+        flock 9
+        local pid kb
+        local reserved=0
+        local entries=()
+        while read -r pid kb; do
+            # drop the reservations of jobs that are gone
+            if kill -0 "$pid" 2> /dev/null; then
+                entries+=("$pid $kb")
+                reserved=$((reserved + kb))
+            fi
+        done < <(cat "$memory_ledger" 2> /dev/null)
+        if [ "${#entries[@]}" -gt 0 ] && [ $((reserved + need)) -gt "$(memory_budget "$reserved")" ]; then
+            exit 1
+        fi
+        entries+=("$owner $need")
+        printf '%s\n' "${entries[@]}" > "$memory_ledger"
+    ) 9> "$memory_ledger.lock"; do
+        if [ "$waiting" -eq 0 ]; then
+            echo "Worker $slot waiting for $((need / 1024)) MiB of memory"
+            waiting=1
+        fi
+        sleep 5
+    done
+    # also seen by the subshells of the job
+    job_owner=$owner
+}
+
+# add the given KiB to the reservation of the admitted job if it still fits,
+# for memory that the sampled rss does not show, like files on tmpfs. a
+# negative amount gives memory back.
+grow_job() {
+    local more=$1
+    if [ -z "$job_owner" ]; then
+        return 0
+    fi
+    (
+        flock 9
+        local pid kb
+        local reserved=0
+        local entries=()
+        while read -r pid kb; do
+            if ! kill -0 "$pid" 2> /dev/null; then
+                continue
+            fi
+            if [ "$pid" = "$job_owner" ]; then
+                kb=$((kb + more))
+            fi
+            entries+=("$pid $kb")
+            reserved=$((reserved + kb))
+        done < <(cat "$memory_ledger" 2> /dev/null)
+        if [ "$more" -gt 0 ] && [ "$reserved" -gt "$(memory_budget $((reserved - more)))" ]; then
+            exit 1
+        fi
+        printf '%s\n' "${entries[@]}" > "$memory_ledger"
+    ) 9> "$memory_ledger.lock"
+}
+
+# release the memory reservation of this worker
+release_job() {
+    local owner=$BASHPID
+    (
+        flock 9
+        grep -v "^$owner " "$memory_ledger" > "$memory_ledger.tmp"
+        mv "$memory_ledger.tmp" "$memory_ledger"
+    ) 9> "$memory_ledger.lock"
+    job_owner=
+}
+
+# remove the least recently used cache entries until the cache fits max_bytes
+cache_evict() {
+    local dir=$1
+    local max_bytes=$2
+    local total size file
+    total=$(find "$dir" -type f -printf '%s\n' | awk '{sum += $1} END {print sum + 0}')
+    find "$dir" -type f -printf '%T@ %s %p\n' \
+        | sort -n \
+        | while read -r _ size file; do
+            if [ "$total" -le "$max_bytes" ]; then
+                break
+            fi
+            rm -f "$file"
+            total=$((total - size))
+        done
+}
+
+# fingerprint of a segment's video packets and the settings used to encode it
+crf_cache_key() {
+    local f=$1
+    shift
+    {
+        ffmpeg -v error -i "$f" -map 0:v:0 -c copy -f hash -hash sha256 -
+        echo "$*"
+    } | sha256sum | cut -d ' ' -f 1
+}
+
+# cut crf_samples samples of crf_sample_duration seconds spread evenly over a
+# segment, or use the whole segment if it is too short to sample
+extract_samples() {
+    local f=$1
+    local dir=$2
+    local duration=${3:-0}
+    local i start
+    if ! awk -v duration="$duration" -v samples="$crf_samples" -v seconds="$crf_sample_duration" \
+        'BEGIN {exit !(duration > samples * seconds)}'; then
+        ffmpeg -v error -y -i "$f" -map 0:v:0 -c copy "$dir/sample-0.mkv"
+        return
+    fi
+    for ((i=0; i<crf_samples; i++)); do
+        start=$(awk -v duration="$duration" -v samples="$crf_samples" -v seconds="$crf_sample_duration" -v i="$i" \
+            'BEGIN {printf "%.3f", duration * (i + 0.5) / samples - seconds / 2}')
+        ffmpeg \
+            -v error \
+            -y \
+            -ss "$start" \
+            -i "$f" \
+            -t "$crf_sample_duration" \
+            -map 0:v:0 \
+            -c copy \
+            "$dir/sample-$i.mkv" || return 1
+    done
+}
+
+# decode the samples once into raw frames, so the probes neither decode the
+# source for every encode nor for every vmaf reference. frames go to the
+# sample buffer while they fit into sample_buffer_size, its free space and
+# the memory budget, and to the crf search directory otherwise, if that is on
+# a local scratch tier with space reserved for them by choose_scratch and
+# they fit into sample_spill_size and the scratch space left. samples that
+# fit neither are decoded by each probe instead, reading raw frames over the
+# network would be slower. buffered frames are cropped. sets buffer_reserved
+# to the KiB of memory reserved for the sample buffer, see
+# free_sample_buffer.
+buffer_samples() {
+    local dir=$1
+    local buffer=$2
+    local cpus=$3
+    local crop=$4
+    local pin=()
+    if [ -n "$cpus" ]; then
+        pin=(taskset -c "$cpus")
+    fi
+    local crop_args=()
+    if [ -n "$crop" ]; then
+        crop_args=(-vf "crop=$crop")
+    fi
+    local sample name frame size available kb
+    local used=0
+    local spilled=0
+    local memory_backed=0
+    local spill=0
+    if [ "$spill_samples" -eq 1 ] \
+        && [ "$(stat -c '%d' "$dir")" != "$(stat -c '%d' "$videos_dir")" ]; then
+        spill=1
+    fi
+    if [ -n "$buffer" ] && [ "$(stat -f -c '%T' "$buffer")" = "tmpfs" ]; then
+        memory_backed=1
+    fi
+    buffer_reserved=0
+    for sample in "$dir"/sample-*.mkv; do
+        name=$(basename "$sample" .mkv)
+        # decoded on the scratch tier by an interrupted search
+        if [ -f "$dir/$name.y4m" ]; then
+            continue
+        fi
+        # 10 bit 4:2:0, 3 bytes per pixel
+        size=$(ffprobe \
             -v error \
-            -select_streams "a:$i" \
-            -show_entries stream=channels \
+            -select_streams v:0 \
+            -count_packets \
+            -show_entries stream=width,height,nb_read_packets \
             -of csv=p=0 \
-            "$input_path")
-        bitrate=$((num_audio_channels * 64))
-        echo "Encoding audio track $i with $num_audio_channels channels at ${bitrate}k"
-        ffmpeg \
-            -i "$input_path" \
-            -map "0:a:$i" \
-            -c:a libopus \
-            -af aformat=channel_layouts="7.1|5.1|stereo|mono" \
-            -b:a "${bitrate}k" \
-            "$working_dir/audio-$i.mkv"
+            "$sample" | awk -F ',' -v crop="$crop" '{
+                if (crop != "") {
+                    split(crop, area, ":")
+                    $1 = area[1]
+                    $2 = area[2]
+                }
+                printf "%.0f\n", $1 * $2 * 3 * $3
+            }')
+        if [ -z "$size" ]; then
+            continue
+        fi
+        available=0
+        if [ -n "$buffer" ]; then
+            available=$(df --output=avail -B 1 "$buffer" | tail -n 1)
+        fi
+        # tmpfs pages are charged to the memory limit but not to the rss of
+        # the job, so they are reserved with it
+        kb=0
+        if [ "$memory_backed" -eq 1 ]; then
+            kb=$(((size + 1023) / 1024))
+        fi
+        if [ $((used + size)) -le "$sample_buffer_size" ] \
+            && [ "$size" -lt "$available" ] \
+            && grow_job "$kb"; then
+            buffer_reserved=$((buffer_reserved + kb))
+            frame="$buffer/$name.y4m"
+        elif [ "$spill" -eq 1 ] \
+            && [ $((spilled + size)) -le "$sample_spill_size" ] \
+            && [ "$size" -lt "$(scratch_free "$dir")" ]; then
+            frame="$dir/$name.y4m"
+        else
+            continue
+        fi
+        if "${pin[@]}" ffmpeg \
+            -v error \
+            -y \
+            -i "$sample" \
+            -map 0:v:0 \
+            "${crop_args[@]}" \
+            -pix_fmt yuv420p10le \
+            -strict -1 \
+            -f yuv4mpegpipe \
+            "$frame.partial" \
+            && mv "$frame.partial" "$frame"; then
+            if [ "$frame" = "$buffer/$name.y4m" ]; then
+                used=$((used + size))
+            else
+                spilled=$((spilled + size))
+            fi
+        else
+            rm -f "$frame.partial"
+            if [ "$frame" = "$buffer/$name.y4m" ]; then
+                grow_job "-$kb"
+                buffer_reserved=$((buffer_reserved - kb))
+            fi
+        fi
     done
+    echo "Buffered $((used / 1048576)) MiB of decoded samples in memory" \
+        "and $((spilled / 1048576)) MiB on disk"
 }
 
-remux_tracks() {
-    chapters_exist=$(ffprobe -i "$input_path" -show_chapters -v quiet -of csv=p=0 | wc -l)
-    subtitles_exist=$(ffprobe -i "$input_path" -show_entries stream=index:stream_tags=language -select_streams s -v quiet -of csv=p=0 | wc -l)
+# remove the sample buffer and give the memory reserved for it back
+free_sample_buffer() {
+    local buffer=$1
+    if [ -n "$buffer" ]; then
+        rm -rf "$buffer"
+    fi
+    grow_job "-${buffer_reserved:-0}"
+    buffer_reserved=0
+}
 
-    map_chapters=""
-    if [ "$chapters_exist" -gt 0 ]; then
-        map_chapters="-map 0:c"
+# encode every sample at a crf and print the mean vmaf of the samples. the
+# score of each sample is kept in the search directory, so a search resumed
+# after a failed or released worker only probes what is missing. samples that
+# are not buffered are cropped here, for the encode and the vmaf reference.
+crf_probe() {
+    local dir=$1
+    local buffer=$2
+    local crf=$3
+    local cpus=$4
+    local crop=$5
+    shift 5
+    local pin=()
+    if [ -n "$cpus" ]; then
+        pin=(taskset -c "$cpus")
     fi
+    local sample encoded score score_file crop_filter
+    local crop_args=()
+    local scores=()
+    for sample in "$dir"/sample-*.mkv; do
+        encoded="$dir/crf-$crf-${sample##*/}"
+        score_file="$dir/vmaf-$crf-$(basename "$sample" .mkv)"
+        if [ -s "$score_file" ]; then
+            scores+=("$(cat "$score_file")")
+            continue
+        fi
+        crop_args=()
+        crop_filter=
+        if [ -f "$buffer/$(basename "$sample" .mkv).y4m" ]; then
+            sample="$buffer/$(basename "$sample" .mkv).y4m"
+        elif [ -f "$dir/$(basename "$sample" .mkv).y4m" ]; then
+            sample="$dir/$(basename "$sample" .mkv).y4m"
+        elif [ -n "$crop" ]; then
+            crop_args=(-vf "crop=$crop")
+            crop_filter="crop=$crop,"
+        fi
+        "${pin[@]}" ffmpeg -v error -y -i "$sample" -map 0:v:0 "${crop_args[@]}" "$@" -crf "$crf" "$encoded" \
+            || return 1
+        score=$("${pin[@]}" ffmpeg \
+            -i "$encoded" \
+            -i "$sample" \
+            -lavfi "[0:v]format=yuv420p10le,setpts=PTS-STARTPTS[distorted];[1:v]${crop_filter}format=yuv420p10le,setpts=PTS-STARTPTS[reference];[distorted][reference]libvmaf=$vmaf_options" \
+            -f null - 2>&1 \
+            | grep -oE 'VMAF score: [0-9.]+' \
+            | cut -d ' ' -f 3)
+        if [ -z "$score" ]; then
+            return 1
+        fi
+        echo "$score" > "$score_file.tmp"
+        mv "$score_file.tmp" "$score_file"
+        scores+=("$score")
+        rm -f "$encoded"
+    done
+    echo "${scores[@]}" | awk '{
+        for (i = 1; i <= NF; i++) sum += $i
+        printf "%.2f\n", sum / NF
+    }'
+}
+
+# next crfs to probe: the crf interpolated between the closest passing (lo)
+# and failing (hi) crf on the crf to vmaf curve and its neighbours, or the
+# middle of the range while either end has no score yet
+crf_candidates() {
+    local lo=$1
+    local lo_score=$2
+    local hi=$3
+    local hi_score=$4
+    awk \
+        -v lo="$lo" \
+        -v lo_score="$lo_score" \
+        -v hi="$hi" \
+        -v hi_score="$hi_score" \
+        -v target="$min_vmaf" \
+        -v jobs="$crf_search_jobs" \
+        'BEGIN {
+            if (lo_score != "" && hi_score != "" && lo_score > hi_score) {
+                guess = lo + (lo_score - target) / (lo_score - hi_score) * (hi - lo)
+            } else {
+                guess = (lo + hi) / 2
+            }
+            guess = int(guess)
+            if (guess <= lo) guess = lo + 1
+            if (guess >= hi) guess = hi - 1
+            # the guess and the crf above it bracket the target when the
+            # curve is close to linear, further neighbours in case it is not
+            for (step = 0; found < jobs && step < hi - lo; step++) {
+                for (sign = 1; sign >= -1; sign -= 2) {
+                    crf = guess + (sign > 0 ? step : -step)
+                    if (crf > lo && crf < hi && !(crf in seen) && found < jobs) {
+                        seen[crf]
+                        found++
+                        print crf
+                    }
+                }
+            }
+        }'
+}
 
-    map_subtitles=""
-    if [ "$subtitles_exist" -gt 0 ]; then
-        for ((i=0; i<num_subtitle_tracks; i++)); do
-            map_subtitles+=" -map $i:s"
+# search for the highest crf whose samples reach min_vmaf. candidates are
+# probed crf_search_jobs at a time, the first round spread evenly over the crf
+# range and later rounds around the interpolated crf, until the passing and
+# failing crf are next to each other. prints "crf 30 VMAF 93.12" like ab-av1.
+# samples and scores stay in the working directory of the title until the
+# search completes and are reused while the segment and settings match.
+crf_search() {
+    local f=$1
+    local cpus=$2
+    local duration=$3
+    local crop=$4
+    shift 4
+    local name=${f##*/}
+    local dir="$working_dir/crf-search-${name%.mkv}"
+    local -A scores=()
+    local lo hi crf pid fps keyint candidates buffer settings
+    local pids=()
+    settings="$(stat -c '%s-%Y' "$f") $crop $vmaf_options $crf_samples $crf_sample_duration $*"
+    if [ "$(cat "$dir/settings" 2> /dev/null)" = "$settings" ]; then
+        echo "Resuming crf search with $(find "$dir" -name 'vmaf-*' | wc -l) cached sample scores"
+    else
+        rm -rf "$dir"
+        mkdir -p "$dir"
+        if ! extract_samples "$f" "$dir" "$duration"; then
+            rm -rf "$dir"
+            return 1
+        fi
+        echo "$settings" > "$dir/settings"
+    fi
+    buffer=$(mktemp -d "$sample_buffer_dir/encodingwf-samples.XXXXXX" 2> /dev/null)
+    buffer_samples "$dir" "$buffer" "$cpus" "$crop"
+    # a keyframe every 5 seconds like --keyint 5s of the final encode
+    fps=$(ffprobe -v error -select_streams v:0 -show_entries stream=avg_frame_rate \
+        -of default=noprint_wrappers=1:nokey=1 "$dir/sample-0.mkv")
+    keyint=$(awk -v fps="$fps" 'BEGIN {split(fps, r, "/"); print int(5 * r[1] / (r[2] ? r[2] : 1) + 0.5)}')
+    candidates=$(awk -v lo="$min_crf" -v hi="$max_crf" -v jobs="$crf_search_jobs" 'BEGIN {
+        for (i = 1; i <= jobs; i++) print int(lo + (hi - lo) * i / (jobs + 1) + 0.5)
+    }')
+    while [ -n "$candidates" ]; do
+        pids=()
+        for crf in $candidates; do
+            crf_probe "$dir" "$buffer" "$crf" "$cpus" "$crop" "$@" -g "$keyint" > "$dir/score-$crf" &
+            pids+=($!)
+        done
+        for pid in "${pids[@]}"; do
+            if ! wait "$pid"; then
+                wait
+                free_sample_buffer "$buffer"
+                return 1
+            fi
         done
+        for crf in $candidates; do
+            scores[$crf]=$(cat "$dir/score-$crf")
+            echo "Probed crf $crf: VMAF ${scores[$crf]}"
+        done
+        # lo passes and hi fails. until they are probed min_crf is assumed
+        # to pass and anything above max_crf to fail
+        hi=$((max_crf + 1))
+        for crf in "${!scores[@]}"; do
+            if awk -v score="${scores[$crf]}" -v target="$min_vmaf" 'BEGIN {exit !(score < target)}' \
+                && [ "$crf" -lt "$hi" ]; then
+                hi=$crf
+            fi
+        done
+        lo=$min_crf
+        for crf in "${!scores[@]}"; do
+            if [ "$crf" -lt "$hi" ] && [ "$crf" -gt "$lo" ]; then
+                lo=$crf
+            fi
+        done
+        if [ $((hi - lo)) -gt 1 ]; then
+            candidates=$(crf_candidates "$lo" "${scores[$lo]}" "$hi" "${scores[$hi]}")
+        elif [ -z "${scores[$lo]}" ] && [ "$hi" -gt "$min_crf" ]; then
+            candidates=$lo
+        else
+            candidates=
+        fi
+    done
+    rm -rf "$dir"
+    free_sample_buffer "$buffer"
+    if [ "$hi" -le "$min_crf" ]; then
+        echo "No crf from $min_crf reaches VMAF $min_vmaf"
+        return 1
+    fi
+    echo "crf $lo VMAF ${scores[$lo]}"
+}
+
+encode_segment() {
+    local f=$1
+    local cpus=$2
+    local output=$3
+    local preset resolution
+    preset=$(current_preset)
+    resolution=$(segment_resolution "$f")
+    local encoder_args=(
+        -e libsvtav1
+        --svt tune=0
+        --keyint 5s
+        --preset "$preset"
+        --enc fps_mode=passthrough
+    )
+    local crop
+    crop=$(journal_last '"stage":"crop",' crop)
+    if [ -n "$crop" ]; then
+        encoder_args+=(--vfilter "crop=$crop")
+    fi
+    # settings of the crf search, part of the crf cache key
+    local search_args=(
+        "min-vmaf=$min_vmaf"
+        "vmaf=$vmaf_options"
+        "crf=$min_crf-$max_crf"
+        "samples=$crf_samples"
+        "sample-duration=$crf_sample_duration"
+    )
+    # the encoder settings above for ffmpeg, the probes of the crf search
+    # share the threads of the job
+    local probe_threads=$(((svt_threads + crf_search_jobs - 1) / crf_search_jobs))
+    local probe_args=(
+        -c:v libsvtav1
+        -preset "$preset"
+        -pix_fmt yuv420p10le
+        -svtav1-params "tune=0:lp=$probe_threads"
+        -fps_mode passthrough
+    )
+    local pin=()
+    if [ -n "$cpus" ]; then
+        pin=(taskset -c "$cpus")
     fi
 
-    input_files=("$working_dir/${vid_file}")
-    for ((i=0; i<num_audio_tracks; i++)); do
-        audio_file="${working_dir}/audio-${i}.mkv"
-        if [ -f "$audio_file" ]; then
-            input_files+=("$audio_file")
+    local name duration key entry search crf vmaf cached
+    name=$(basename "$f")
+    duration=$(segment_duration "$name")
+    key=$(crf_cache_key "$f" "${encoder_args[@]}" "${search_args[@]}")
+    entry="$crf_cache_dir/$key"
+    cached="$segment_cache_dir/$key.mkv"
+    if [ -f "$entry" ] && [ -f "$cached" ]; then
+        read -r crf vmaf < "$entry"
+        touch "$entry" "$cached"
+        echo "Using cached encoded segment for $name"
+        echo "crf $crf VMAF $vmaf"
+        ln -f "$cached" "$output" 2> /dev/null || cp "$cached" "$output"
+        return
+    fi
+    if [ -f "$entry" ]; then
+        read -r crf vmaf < "$entry"
+        touch "$entry"
+        echo "Using cached crf search result for $name"
+    else
+        if ! search=$(measure \
+            stage=crf-search \
+            segment="$name" \
+            duration="$duration" \
+            preset="$preset" \
+            resolution="$resolution" \
+            -- crf_search "$f" "$cpus" "$duration" "$crop" "${probe_args[@]}" 2>&1); then
+            echo "$search"
+            return 1
+        fi
+        echo "$search"
+        read -r crf vmaf < <(echo "$search" \
+            | grep -oE 'crf [0-9.]+ VMAF [0-9.]+' \
+            | tail -n 1 \
+            | cut -d ' ' -f 2,4)
+        if [ -z "$crf" ]; then
+            return 1
+        fi
+        echo "$crf $vmaf" > "$entry.$$"
+        mv "$entry.$$" "$entry"
+        cache_evict "$crf_cache_dir" "$crf_cache_max_size"
+    fi
+    echo "crf $crf VMAF $vmaf"
+
+    local pieces
+    pieces=$(split_count "$duration")
+    if [ "$pieces" -gt 1 ] \
+        && split_segment "$f" "$pieces" "$crf" "$vmaf" "${encoder_args[@]}" "${search_args[@]}"; then
+        return 0
+    fi
+
+    measure \
+        stage=encode \
+        segment="$name" \
+        duration="$duration" \
+        preset="$preset" \
+        resolution="$resolution" \
+        -- "${pin[@]}" ab-av1 \
+        encode \
+        "${encoder_args[@]}" \
+        --svt lp="$svt_threads" \
+        --crf "$crf" \
+        --input "$f" \
+        --output "$output" \
+        || return 1
+    if [ "$(stat -c '%d' "$segment_cache_dir")" = "$(stat -c '%d' "$encoded_segment_dir")" ] \
+        && ln -f "$output" "$cached.$$" 2> /dev/null; then
+        mv "$cached.$$" "$cached"
+        cache_evict "$segment_cache_dir" "$segment_cache_max_size"
+    fi
+}
+
+# number of pieces to split a segment into: one more than the number of idle
+# workers once nothing is left to claim, limited by split_min_duration
+split_count() {
+    local duration=$1
+    if [ "$(journal_last '"stage":"segment",' status)" != "done" ] \
+        || unclaimed_segments; then
+        echo 1
+        return
+    fi
+    awk \
+        -v duration="${duration:-0}" \
+        -v min="$split_min_duration" \
+        -v idle="$(count_idle_workers)" \
+        'BEGIN {
+            pieces = int(duration / min)
+            if (pieces > idle + 1) pieces = idle + 1
+            print pieces < 1 ? 1 : pieces
+        }'
+}
+
+# split a segment at keyframes into pieces for idle workers and replace it
+# with them in the segment list. the pieces reuse the crf search result of
+# the whole segment through the crf cache.
+split_segment() {
+    local f=$1
+    local pieces=$2
+    local crf=$3
+    local vmaf=$4
+    shift 4
+    local name=${f##*/}
+    local base=${name%.mkv}
+    local list="$segment_dir/$base.split.csv"
+    local start duration times piece entry
+    read -r start duration < <(awk -F ',' -v name="$name" \
+        '$1 == name {print $2, $3 - $2}' "$segment_dir/segments.csv")
+    times=$(awk -v duration="$duration" -v pieces="$pieces" 'BEGIN {
+        for (i = 1; i < pieces; i++)
+            printf "%s%.3f", (i > 1 ? "," : ""), duration * i / pieces
+    }')
+    if ! measure stage=split segment="$name" duration="$duration" -- ffmpeg \
+        -v error \
+        -y \
+        -i "$f" \
+        -map 0 \
+        -c copy \
+        -f segment \
+        -segment_times "$times" \
+        -segment_list "$list" \
+        -segment_list_type csv \
+        -reset_timestamps 1 \
+        "$segment_dir/$base-%02d.mkv" \
+        || [ "$(wc -l < "$list")" -lt 2 ]; then
+        # no keyframe to cut at, encode the segment as a whole
+        rm -f "$list" "$segment_dir/$base"-[0-9][0-9].mkv
+        return 1
+    fi
+    for piece in $(cut -d ',' -f 1 "$list"); do
+        entry="$crf_cache_dir/$(crf_cache_key "$segment_dir/$piece" "$@")"
+        echo "$crf $vmaf" > "$entry.$$"
+        mv "$entry.$$" "$entry"
+    done
+    (
+        flock 9
+        awk -F ',' -v OFS=',' -v name="$name" -v start="$start" -v list="$list" '
+            $1 == name {
+                while ((getline line < list) > 0) {
+                    split(line, piece, ",")
+                    print piece[1], start + piece[2], start + piece[3]
+                }
+                next
+            }
+            {print}' "$segment_dir/segments.csv" > "$segment_dir/segments.csv.tmp"
+        mv "$segment_dir/segments.csv.tmp" "$segment_dir/segments.csv"
+    ) 9> "$segment_dir/segments.lock"
+    echo "Split $name into $(cut -d ',' -f 1 "$list" | paste -sd ',')"
+    rm -f "$list" "$f"
+}
+
+# journal the results workers left next to their encoded segments. when
+# streaming, source segments are deleted once their encode is verified.
+# segments split into pieces are replaced by them.
+collect_results() {
+    local result name fields piece
+    for result in "$encoded_segment_dir"/*.mkv.result; do
+        [ -f "$result" ] || continue
+        name=$(basename "$result" .result)
+        fields=$(cat "$result")
+        journal stage=encode segment="$name" $fields
+        rm -f "$result"
+        if [[ "$fields" == status=split* ]]; then
+            for piece in $(echo "${fields##*pieces=}" | tr ',' ' '); do
+                # the splitting worker may have encoded the piece already
+                if [ -z "$(journal_last "\"segment\":\"$piece\"," status)" ]; then
+                    journal stage=encode segment="$piece" status=pending
+                fi
+            done
+            continue
+        fi
+        if [ "$streaming" -eq 1 ] \
+            && output_done "\"segment\":\"$name\"," "$encoded_segment_dir/$name"; then
+            rm -f "$segment_dir/$name"
+        fi
+    done
+}
+
+# segments that were deleted after encoding can only be resumed as long as
+# their encoded output is still intact
+segments_intact() {
+    local output name
+    for output in "$encoded_segment_dir"/*.mkv; do
+        [ -f "$output" ] || continue
+        name=$(basename "$output")
+        if [ ! -f "$segment_dir/$name" ] \
+            && ! output_done "\"segment\":\"$name\"," "$output"; then
+            return 1
+        fi
+    done
+}
+
+# segments the segment muxer has finished writing
+closed_segments() {
+    cut -d ',' -f 1 "$segment_dir/segments.csv" 2> /dev/null
+}
+
+reset_claims() {
+    collect_results
+    rm -rf "$encoded_segment_dir"/.claims-*
+    mkdir -p "$claim_dir"
+    declare -gA queued_segments=()
+}
+
+# mark segments without a trusted encoded output as pending for the workers
+queue_segments() {
+    local name
+    for name in "$@"; do
+        if [ -n "${queued_segments[$name]}" ]; then
+            continue
+        fi
+        queued_segments[$name]=1
+        if ! output_done "\"segment\":\"$name\"," "$encoded_segment_dir/$name"; then
+            journal stage=encode segment="$name" status=pending
+        fi
+    done
+}
+
+# make a ready title visible to worker nodes
+publish_title() {
+    if [ "$distributed" -eq 1 ]; then
+        printf '%s\n%s\n' "$run_id" "$input_path" > "$queue_dir/$run_id-$vid_file.job"
+    fi
+}
+
+unpublish_title() {
+    rm -f "$queue_dir/$run_id-$vid_file.job"
+}
+
+count_pending_segments() {
+    # segments still being cut cannot be counted yet
+    if [ "$(journal_last '"stage":"segment",' status)" = "started" ]; then
+        echo 0
+        return
+    fi
+    grep -F '"stage":"encode",' "$journal_file" 2> /dev/null \
+        | sed -n 's/.*"segment":"\([^"]*\)".*"status":"\([^"]*\)".*/\1 \2/p' \
+        | awk '{status[$1] = $2} END {for (s in status) n += status[s] == "pending"; print n + 0}'
+}
+
+wait_ready() {
+    local pid=$1
+    until [ "$(journal_last '"stage":"ready",' run)" = "$run_id" ]; do
+        kill -0 "$pid" 2> /dev/null || return 1
+        sleep 5
+    done
+}
+
+# closed segments of the title that still exist, most expensive first. the
+# cost of a segment is its duration times its bitrate relative to the rest of
+# the title, which orders the same as the size of the stream copy.
+segments_by_cost() {
+    local name
+    for name in $(closed_segments); do
+        if [ -f "$segment_dir/$name" ]; then
+            echo "$(stat -c '%s' "$segment_dir/$name") $name"
+        fi
+    done | sort -rn | cut -d ' ' -f 2
+}
+
+# true while the title has pending segments nobody has claimed yet
+unclaimed_segments() {
+    local name
+    for name in $(closed_segments); do
+        if [ "$(journal_last "\"segment\":\"$name\"," status)" = "pending" ] \
+            && [ ! -d "$claim_dir/$name" ] \
+            && [ ! -f "$encoded_segment_dir/$name.result" ]; then
+            return 0
+        fi
+    done
+    return 1
+}
+
+# true while segments of the title are pending or their results uncollected,
+# as split pieces of them may still turn up, until the coordinator closes it
+title_unresolved() {
+    local name
+    if [ "$(journal_last '"stage":"ready",' status)" != "done" ]; then
+        return 1
+    fi
+    for name in $(closed_segments); do
+        if [ "$(journal_last "\"segment\":\"$name\"," status)" = "pending" ]; then
+            return 0
+        fi
+    done
+    [ -n "$(find "$encoded_segment_dir" -maxdepth 1 -name '*.result' 2> /dev/null)" ]
+}
+
+# workers waiting for work keep a marker in idle_dir fresh. recent markers are
+# counted when deciding how far to split the last segments.
+mark_idle() {
+    touch "$idle_dir/$HOSTNAME-$$-$1"
+}
+
+mark_busy() {
+    rm -f "$idle_dir/$HOSTNAME-$$-$1"
+}
+
+count_idle_workers() {
+    find "$idle_dir" -type f -mmin -1 2> /dev/null | wc -l
+}
+
+# claim and encode the pending segments of the loaded title, most expensive
+# first. results are written next to the encoded segment and journaled by the
+# coordinator, so workers on other nodes never append to the shared journal.
+# with linger set the worker waits for split pieces until the title is
+# resolved. returns non-zero if nothing was claimed.
+encode_title_segments() {
+    local slot=$1
+    local cpus=$2
+    local linger=${3:-0}
+    local f name output claim log result heartbeat_pid segmenting claimed status piece
+    local worked=1
+    # pieces this worker split off, pending before the coordinator says so
+    local -A pieces=()
+    while true; do
+        segmenting=0
+        if [ "$(journal_last '"stage":"segment",' status)" = "started" ]; then
+            segmenting=1
+        fi
+        claimed=0
+        for name in $(segments_by_cost); do
+            f="$segment_dir/$name"
+            output="$encoded_segment_dir/$name"
+            claim="$claim_dir/$name"
+            log="$title_log_dir/segment-${name%.mkv}.log"
+            status=$(journal_last "\"segment\":\"$name\"," status)
+            if [ -z "$status" ] && [ -n "${pieces[$name]}" ]; then
+                status=pending
+            fi
+            if [ "$status" != "pending" ] || [ -f "$output.result" ] || [ -d "$claim" ]; then
+                continue
+            fi
+            admit_job "$slot" "$(job_memory "$(segment_resolution "$f")")"
+            if ! mkdir "$claim" 2> /dev/null; then
+                release_job
+                continue
+            fi
+            claimed=1
+            worked=0
+            mark_busy "$slot"
+            echo "$HOSTNAME $slot" > "$claim/owner"
+            echo "Worker $slot encoding $vid_file segment $name${cpus:+ on cpus $cpus}"
+            # keep the claim fresh so it is not released while the encode runs
+            (while sleep "$claim_heartbeat"; do touch "$claim"; done) &
+            heartbeat_pid=$!
+            rm -f "$output"
+            if ! encode_segment "$f" "$cpus" "$output" > "$log" 2>&1; then
+                echo "Encoding $vid_file segment $name failed, see $log" >&2
+                echo "status=failed" > "$output.result.tmp"
+            elif result=$(grep -oE "^Split $name into .*" "$log"); then
+                echo "$result"
+                echo "status=split pieces=${result##* }" > "$output.result.tmp"
+                for piece in $(echo "${result##* }" | tr ',' ' '); do
+                    pieces[$piece]=1
+                done
+            else
+                result=$(grep -oE 'crf [0-9.]+ VMAF [0-9.]+' "$log" | tail -n 1)
+                echo "status=done" \
+                    "crf=$(echo "$result" | cut -d ' ' -f 2)" \
+                    "vmaf=$(echo "$result" | cut -d ' ' -f 4)" \
+                    "sha256=$(sha256sum "$output" | cut -d ' ' -f 1)" \
+                    > "$output.result.tmp"
+            fi
+            mv "$output.result.tmp" "$output.result"
+            kill "$heartbeat_pid"
+            release_job
+            # start over from the most expensive segment left
+            break
+        done
+        if [ "$claimed" -eq 1 ]; then
+            continue
+        fi
+        if [ "$segmenting" -eq 0 ] \
+            && { [ "$linger" -eq 0 ] || ! title_unresolved; }; then
+            # moving on, not idle for splits of this title
+            mark_busy "$slot"
+            return $worked
+        fi
+        mark_idle "$slot"
+        sleep 5
+    done
+}
+
+# encode the segments of each title in turn, so workers move on to the next
+# title of the queue while the last segments finish. on the last title they
+# stay around to take pieces of split segments.
+encode_worker() {
+    local slot=$1
+    local cpus=$2
+    shift 2
+    local title
+    local linger=0
+    for title in "$@"; do
+        load_title "$title"
+        until [ "$(journal_last '"stage":"ready",' run)" = "$run_id" ]; do
+            # leased by another coordinator
+            if [ -f "$queue_dir/$run_id-$vid_file.skip" ]; then
+                continue 2
+            fi
+            sleep 5
+        done
+        # the scratch tiers of the title are journaled by now
+        load_title "$title"
+        if [ "$title" = "${*: -1}" ]; then
+            linger=1
+        fi
+        if [ "$(journal_last '"stage":"ready",' status)" = "done" ]; then
+            encode_title_segments "$slot" "$cpus" "$linger"
+        fi
+    done
+    mark_busy "$slot"
+}
+
+# encode segments of titles published by coordinators, until stopped
+remote_worker() {
+    local slot=$1
+    local cpus=$2
+    local job idle
+    while true; do
+        idle=1
+        for job in "$queue_dir"/*.job; do
+            [ -f "$job" ] || continue
+            {
+                read -r run_id
+                read -r input_path
+            } < "$job"
+            load_title "$input_path"
+            if encode_title_segments "$slot" "$cpus"; then
+                idle=0
+            fi
+        done
+        if [ "$idle" -eq 1 ]; then
+            mark_idle "$slot"
         else
-            echo "Audio file $audio_file not found." >&2
-            exit 1
+            mark_busy "$slot"
+        fi
+        sleep 10
+    done
+}
+
+start_workers() {
+    local num_segments=$1
+    shift
+    local slot
+    worker_pids=()
+    if [ "$distributed" -eq 1 ] && [ "$local_encode" -eq 0 ]; then
+        echo "Leaving segment encoding to worker nodes"
+        return
+    fi
+    plan_parallelism "$num_segments"
+    for ((slot=0; slot<encode_jobs; slot++)); do
+        encode_worker "$slot" "$(slot_cpus "$slot")" "$@" &
+        worker_pids+=("$!")
+    done
+}
+
+workers_running() {
+    local pid
+    for pid in "${worker_pids[@]}"; do
+        if kill -0 "$pid" 2> /dev/null; then
+            return 0
+        fi
+    done
+    return 1
+}
+
+# release a segment claim whose worker stopped refreshing it
+release_stale_claim() {
+    local claim=$1
+    local age
+    [ -d "$claim" ] || return 0
+    age=$(($(date +%s) - $(stat -c '%Y' "$claim")))
+    if [ "$age" -gt "$claim_timeout" ]; then
+        echo "Releasing stale claim on $vid_file segment $(basename "$claim") ($(cat "$claim/owner" 2> /dev/null))"
+        rm -rf "$claim"
+    fi
+}
+
+# true while another coordinator holds a lease on the loaded title
+title_leased() {
+    local lease="$lease_dir/$vid_file"
+    [ -d "$lease" ] || return 1
+    [ "$(cat "$lease/owner" 2> /dev/null)" != "$HOSTNAME $$ $run_id" ] || return 1
+    [ $(($(date +%s) - $(stat -c '%Y' "$lease" 2> /dev/null || echo 0))) -le "$claim_timeout" ]
+}
+
+# lease the loaded title to this coordinator so coordinators sharing the
+# videos volume never encode the same title. the lease is created with an
+# atomic mkdir and refreshed until it is released or this coordinator exits,
+# a lease that went stale is taken over and its job resumed.
+take_lease() {
+    local lease="$lease_dir/$vid_file"
+    local owner="$HOSTNAME $$ $run_id"
+    # unique across containers, where $$ is always 1
+    local stale="$lease.stale-$HOSTNAME-$run_id"
+    declare -gA lease_heartbeats
+    if ! mkdir "$lease" 2> /dev/null; then
+        if title_leased; then
+            return 1
+        fi
+        if [ "$(cat "$lease/owner" 2> /dev/null)" != "$owner" ]; then
+            # move the stale lease aside first, so only one coordinator
+            # takes it over
+            mv -T "$lease" "$stale" 2> /dev/null || return 1
+            if [ $(($(date +%s) - $(stat -c '%Y' "$stale"))) -le "$claim_timeout" ]; then
+                # refreshed or taken over in the meantime. its owner restores
+                # it if a new lease was taken before it was moved back.
+                mv -T "$stale" "$lease" 2> /dev/null || rm -rf "$stale"
+                return 1
+            fi
+            echo "Taking over stale lease on $vid_file ($(cat "$stale/owner" 2> /dev/null))"
+            rm -rf "$stale"
+            mkdir "$lease" 2> /dev/null || return 1
+        fi
+    fi
+    if ! echo "$owner" > "$lease/owner"; then
+        return 1
+    fi
+    # stops once the lease is released or another owner is seen, a lease
+    # that is briefly moved aside by a coordinator checking it is restored
+    (while sleep "$claim_heartbeat" && kill -0 $$ 2> /dev/null; do
+        current=$(cat "$lease/owner" 2> /dev/null)
+        if [ -n "$current" ] && [ "$current" != "$owner" ]; then
+            break
+        fi
+        if [ -d "$lease" ]; then
+            touch -c "$lease"
+        elif mkdir "$lease" 2> /dev/null; then
+            echo "$owner" > "$lease/owner"
+        fi
+    done) > /dev/null 2>&1 &
+    lease_heartbeats[$vid_file]=$!
+}
+
+# release the lease of this coordinator on the loaded title
+release_lease() {
+    local lease="$lease_dir/$vid_file"
+    if [ -n "${lease_heartbeats[$vid_file]}" ]; then
+        kill "${lease_heartbeats[$vid_file]}" 2> /dev/null
+        unset "lease_heartbeats[$vid_file]"
+    fi
+    if [ "$(cat "$lease/owner" 2> /dev/null)" = "$HOSTNAME $$ $run_id" ]; then
+        rm -rf "$lease"
+    fi
+}
+
+# set lease_index to the first title of the run from the given index on that
+# this coordinator could lease. the titles before it are leased by other
+# coordinators and are skipped, also by the workers of this run.
+lease_next_title() {
+    lease_index=$1
+    while ((lease_index < ${#titles[@]})); do
+        load_title "${titles[lease_index]}"
+        if take_lease; then
+            return
+        fi
+        echo "Skipping $vid_file, leased by $(cat "$lease_dir/$vid_file/owner" 2> /dev/null)"
+        touch "$queue_dir/$run_id-$vid_file.skip"
+        lease_index=$((lease_index + 1))
+    done
+}
+
+# wait until every segment of the title is encoded, fail if any of them failed
+wait_for_segments() {
+    local name status waiting
+    while true; do
+        collect_results
+        waiting=0
+        for name in $(closed_segments); do
+            status=$(journal_last "\"segment\":\"$name\"," status)
+            case "$status" in
+                done) ;;
+                failed) return 1 ;;
+                *)
+                    waiting=1
+                    release_stale_claim "$claim_dir/$name"
+                    ;;
+            esac
+        done
+        if [ "$waiting" -eq 0 ]; then
+            return 0
+        fi
+        # worker nodes may still pick up the remaining segments
+        if ! workers_running && [ "$distributed" -eq 0 ]; then
+            return 1
+        fi
+        if [ -n "$deadline_epoch" ]; then
+            plan_preset "$(awk -v current="$(remaining_duration)" -v later="$later_duration" \
+                'BEGIN {print current + later}')"
+        fi
+        sleep 10
+    done
+}
+
+# preset for the segments encoded now, as published by the coordinator of the
+# run when it has a deadline
+current_preset() {
+    local preset
+    preset=$(cat "$queue_dir/$run_id.preset" 2> /dev/null)
+    echo "${preset:-$preset_setting}"
+}
+
+# seconds of video of the loaded title that are not encoded yet
+remaining_duration() {
+    local name
+    for name in $(closed_segments); do
+        if [ "$(journal_last "\"segment\":\"$name\"," status)" != "done" ]; then
+            segment_duration "$name"
+        fi
+    done | awk '{sum += $1} END {printf "%.3f\n", sum}'
+}
+
+# pick the slowest preset that still finishes the remaining video of the run
+# before the deadline and publish it to the workers. the throughput of the
+# crf searches and encodes of the run so far is scaled to other presets with
+# a table of their relative speed, and multiplied by the average number of
+# segments encoded at the same time.
+plan_preset() {
+    local remaining=$1
+    local preset current dir
+    current=$(current_preset)
+    preset=$(for dir in "${titles_log_dirs[@]}"; do
+        cat "$dir"/metrics-*.jsonl 2> /dev/null
+    done | awk \
+        -v run_start="$run_start" \
+        -v now="$EPOCHSECONDS" \
+        -v deadline="$deadline_epoch" \
+        -v margin="$deadline_margin" \
+        -v remaining="$remaining" \
+        -v current="$current" \
+        -v min_preset="$min_preset" \
+        -v max_preset="$max_preset" '
+        function field(name,    value) {
+            if (!match($0, "\"" name "\":[^,}]*")) return ""
+            value = substr($0, RSTART + length(name) + 3, RLENGTH - length(name) - 3)
+            gsub(/"/, "", value)
+            return value
+        }
+        BEGIN {
+            # speed of svt-av1 presets 0 to 13 relative to preset 4
+            split("0.1 0.2 0.35 0.6 1 1.5 2.3 3.3 4.8 6.5 9 12 16 20", speeds, " ")
+            for (p = 0; p <= 13; p++) speed[p] = speeds[p + 1]
+        }
+        field("status") == 0 && field("start") + 0 >= run_start {
+            stage = field("stage")
+            if (stage != "crf-search" && stage != "encode") next
+            wall = field("wall") + 0
+            busy += wall
+            # the time the work would have taken at preset 4
+            normalized += wall * speed[field("preset") + 0]
+            if (stage == "encode") {
+                encoded += field("duration")
+                segments++
+            }
+            start = field("start") + 0
+            if (first == "" || start < first + 0) first = start
+        }
+        END {
+            if (segments < 2 || normalized <= 0 || now <= first) {
+                print current
+                exit
+            }
+            # seconds of video per second at preset 4, over all jobs
+            throughput = encoded / normalized * busy / (now - first)
+            left = (deadline - now) * (1 - margin)
+            needed = left > 0 ? remaining / (throughput * left) : speed[max_preset]
+            for (p = min_preset; p < max_preset && speed[p] < needed; p++);
+            print p
+        }')
+    if [ "$preset" != "$current" ]; then
+        echo "Switching to preset $preset to finish by $(date -d "@$deadline_epoch" +%H:%M)"
+        echo "$preset" > "$queue_dir/$run_id.preset.tmp"
+        mv "$queue_dir/$run_id.preset.tmp" "$queue_dir/$run_id.preset"
+    fi
+}
+
+# ffmpeg output arguments copying every audio track that still needs encoding
+audio_copy_args() {
+    local i
+    for ((i=0; i<num_audio_tracks; i++)); do
+        if ! output_done "\"track\":\"$i\"," "$audio_dir/audio-$i.mkv"; then
+            printf '%s\n' -map "0:a:$i" -c copy "$audio_dir/source-audio-$i.mka"
         fi
     done
+}
 
-    ffmpeg_cmd=(ffmpeg)
-    for vid_file in "${input_files[@]}"; do
-        ffmpeg_cmd+=(-i "$vid_file")
+# copy the audio tracks out of the source in a single demux pass
+extract_audio() {
+    local audio_args i
+    mapfile -t audio_args < <(audio_copy_args)
+    if [ "${#audio_args[@]}" -eq 0 ]; then
+        return
+    fi
+    # write to temporary names so an interrupted pass is never reused
+    for ((i=0; i<${#audio_args[@]}; i++)); do
+        if [[ "${audio_args[i]}" == *.mka ]]; then
+            audio_args[i]="${audio_args[i]%.mka}.partial.mka"
+        fi
     done
+    ffmpeg -y -i "$input_path" "${audio_args[@]}" || return 1
     for ((i=0; i<num_audio_tracks; i++)); do
-        ffmpeg_cmd+=(-map "$i:a?")
+        if [ -f "$audio_dir/source-audio-$i.partial.mka" ]; then
+            mv "$audio_dir/source-audio-$i.partial.mka" "$audio_dir/source-audio-$i.mka"
+        fi
     done
-    ffmpeg_cmd+=(-c copy "${output_dir}/${vid_file}")
+}
 
-    "${ffmpeg_cmd[@]}"
+encode_audio_track() {
+    local i=$1
+    local source_audio="$audio_dir/source-audio-$i.mka"
+    local audio_file="$audio_dir/audio-$i.mkv"
+    local num_audio_channels bitrate
+    num_audio_channels=$(media_stream audio "$i" channels)
+    bitrate=$((num_audio_channels * 64))
+    echo "Encoding audio track $i with $num_audio_channels channels at ${bitrate}k"
+    measure stage=audio track="$i" -- ffmpeg \
+        -y \
+        -i "$source_audio" \
+        -map 0:a:0 \
+        -c:a libopus \
+        -af aformat=channel_layouts="7.1|5.1|stereo|mono" \
+        -b:a "${bitrate}k" \
+        "$audio_file" \
+        > "$title_log_dir/audio-$i.log" 2>&1 \
+        || return 1
+    journal \
+        stage=audio \
+        track="$i" \
+        status=done \
+        bitrate="${bitrate}k" \
+        sha256="$(sha256sum "$audio_file" | cut -d ' ' -f 1)"
+}
+
+# encode all audio tracks in parallel from their copies out of the source
+encode_audio() {
+    local i pid
+    local pids=()
+    local status=0
+    for ((i=0; i<num_audio_tracks; i++)); do
+        if ! output_done "\"track\":\"$i\"," "$audio_dir/audio-$i.mkv" \
+            && [ ! -f "$audio_dir/source-audio-$i.mka" ]; then
+            extract_audio || return 1
+            break
+        fi
+    done
+    for ((i=0; i<num_audio_tracks; i++)); do
+        if output_done "\"track\":\"$i\"," "$audio_dir/audio-$i.mkv"; then
+            echo "Audio track $i already encoded"
+            continue
+        fi
+        encode_audio_track "$i" &
+        pids+=("$!")
+    done
+    for pid in "${pids[@]}"; do
+        wait "$pid" || status=1
+    done
+    if [ "$status" -eq 0 ]; then
+        rm -f "$audio_dir"/source-audio-*.mka
+    fi
+    return $status
+}
+
+# mux the encoded segments, read in order through the concat demuxer, with the
+# encoded audio and the subtitles, chapters and attachments of the source in
+# one pass. the title tags of the source are kept, and the language, title
+# and disposition of the video and audio streams that were encoded.
+remux_tracks() {
+    local i name audio_file tag value
+    local output="$output_dir/$vid_file.mkv"
+    local partial="$output_dir/$vid_file.partial.mkv"
+    local muxed="$mux_dir/$vid_file.mkv"
+    local segment_list="$encoded_segment_dir/segments.txt"
+    # the source is the input after the audio tracks
+    local source_input=$((num_audio_tracks + 1))
+
+    # encoded segments in the order of the segment list, which also holds
+    # the pieces of split segments in place of them. the names are relative
+    # to the list, so quotes in the title never reach it.
+    for name in $(closed_segments); do
+        echo "file '$name'"
+    done > "$segment_list"
+
+    local ffmpeg_cmd=(ffmpeg -y -f concat -safe 0 -i "$segment_list")
+    for ((i=0; i<num_audio_tracks; i++)); do
+        audio_file="$audio_dir/audio-$i.mkv"
+        if [ ! -f "$audio_file" ]; then
+            echo "Audio file $audio_file not found." >&2
+            return 1
+        fi
+        ffmpeg_cmd+=(-i "$audio_file")
+    done
+    ffmpeg_cmd+=(-i "$input_path" -map 0:v)
+    for ((i=0; i<num_audio_tracks; i++)); do
+        ffmpeg_cmd+=(-map "$((i + 1)):a")
+    done
+    if [ "${media[subtitle.count]:-0}" -gt 0 ]; then
+        ffmpeg_cmd+=(-map "$source_input:s")
+    fi
+    if [ "${media[attachment.count]:-0}" -gt 0 ]; then
+        ffmpeg_cmd+=(-map "$source_input:t")
+    fi
+    if [ "${media[chapters.count]:-0}" -gt 0 ]; then
+        ffmpeg_cmd+=(-map_chapters "$source_input")
+    fi
+    ffmpeg_cmd+=(-map_metadata "$source_input")
+    for tag in language title; do
+        value=$(media_stream video 0 "tags.$tag")
+        if [ -n "$value" ]; then
+            ffmpeg_cmd+=(-metadata:s:v:0 "$tag=$value")
+        fi
+    done
+    ffmpeg_cmd+=(-disposition:v:0 "$(media_disposition video 0)")
+    for ((i=0; i<num_audio_tracks; i++)); do
+        for tag in language title; do
+            value=$(media_stream audio "$i" "tags.$tag")
+            if [ -n "$value" ]; then
+                ffmpeg_cmd+=("-metadata:s:a:$i" "$tag=$value")
+            fi
+        done
+        ffmpeg_cmd+=("-disposition:a:$i" "$(media_disposition audio "$i")")
+    done
+    # keep the default flags of the source instead of letting the muxer pick
+    ffmpeg_cmd+=(-c copy -default_mode passthrough "$muxed")
+
+    # only the finished output is written to the output directory, under a
+    # temporary name while it is copied off the scratch tier
+    "${ffmpeg_cmd[@]}" && mv "$muxed" "$partial" && mv "$partial" "$output"
+}
+
+# segment a title and encode its audio, the encode workers pick up the
+# segments as soon as the title is marked ready
+prepare_title() {
+    mkdir -p "$title_log_dir"
+    start_journal
+    if ! probe_media; then
+        echo "Probing $vid_file failed." >&2
+        journal stage=ready status=failed run="$run_id"
+        return 1
+    fi
+    # checked before anything is written, instead of failing halfway
+    if ! choose_scratch; then
+        journal stage=ready status=failed run="$run_id"
+        return 1
+    fi
+    mkdir -p "$segment_dir" "$encoded_segment_dir" "$working_dir" "$audio_dir" "$mux_dir"
+    reset_claims
+    if ! stage_done crop; then
+        local crop=
+        if [ "$crop_samples" -gt 0 ]; then
+            echo "Detecting black bars of $vid_file"
+            crop=$(measure stage=crop -- detect_crop)
+        fi
+        if [ -n "$crop" ]; then
+            echo "Cropping $vid_file to $crop"
+        fi
+        journal stage=crop status=done crop="$crop"
+    fi
+    if stage_done segment && segments_intact; then
+        echo "Segments of $vid_file already complete, skipping segmentation"
+        queue_segments $(closed_segments)
+        journal stage=ready status=done run="$run_id"
+        publish_title
+    else
+        echo "Begin segmenting $vid_file"
+        rm -rf "${segment_dir:?}"/* "${encoded_segment_dir:?}"/*
+        journal stage=segment status=started
+        local segment_pid segmented
+        if [ "$streaming" -eq 1 ]; then
+            # workers pick up segments while the rest are still being written
+            journal stage=ready status=done run="$run_id"
+            publish_title
+            segment_video &
+            segment_pid=$!
+            while kill -0 "$segment_pid" 2> /dev/null; do
+                queue_segments $(closed_segments)
+                collect_results
+                sleep 2
+            done
+            wait "$segment_pid"
+            segmented=$?
+        else
+            segment_video
+            segmented=$?
+        fi
+        if [ "$segmented" -ne 0 ]; then
+            echo "Segmenting $vid_file failed." >&2
+            journal stage=segment status=failed
+            journal stage=ready status=failed run="$run_id"
+            return 1
+        fi
+        queue_segments $(closed_segments)
+        journal stage=segment status=done
+        if [ "$streaming" -ne 1 ]; then
+            journal stage=ready status=done run="$run_id"
+            publish_title
+        fi
+    fi
+
+    echo "Begin encoding audio for $vid_file"
+    if ! encode_audio; then
+        echo "Audio encoding failed for $vid_file." >&2
+        return 1
+    fi
+    journal stage=audio status=done
+}
+
+# wait for the encoded segments of a title, then mux them with its tracks
+finish_title() {
+    echo "Waiting for segments of $vid_file"
+    if ! wait_for_segments; then
+        echo "Segment encoding failed for $vid_file." >&2
+        unpublish_title
+        return 1
+    fi
+    unpublish_title
+    echo "Begin muxing segments and tracks of $vid_file"
+    probe_media || return 1
+    if ! measure stage=remux -- remux_tracks; then
+        echo "Remuxing failed for $vid_file." >&2
+        return 1
+    fi
+    journal stage=remux status=done
+    journal stage=job status=done source="$(source_id)"
+    echo "Encoding of $vid_file complete"
+    write_report
+
+    # cleanup, only reached once the output is complete
+    rm -rf \
+        "$segment_dir" \
+        "$encoded_segment_dir" \
+        "$working_dir" \
+        "$audio_dir" \
+        "$mux_dir"
+}
+
+# summarize the metrics of a title per stage, written next to its journal
+write_report() {
+    local fps
+    fps=$(media_stream video 0 avg_frame_rate)
+    cat "$title_log_dir"/metrics-*.jsonl 2> /dev/null | awk -v fps="${fps:-0}" '
+        function field(name,    value) {
+            if (!match($0, "\"" name "\":[^,}]*")) return ""
+            value = substr($0, RSTART + length(name) + 3, RLENGTH - length(name) - 3)
+            gsub(/"/, "", value)
+            return value
+        }
+        BEGIN {
+            split(fps, rate, "/")
+            fps = rate[2] > 0 ? rate[1] / rate[2] : rate[1]
+            num_stages = split("crop scenes segment crf-search split encode audio remux", order, " ")
+        }
+        {
+            stage = field("stage")
+            start = field("start") + 0
+            wall = field("wall") + 0
+            rss = field("peak_rss_kb") + 0
+            count[stage]++
+            walls[stage] += wall
+            cpu[stage] += field("user") + field("system")
+            if (rss > peak[stage]) peak[stage] = rss
+            read_bytes[stage] += field("read_bytes")
+            written_bytes[stage] += field("written_bytes")
+            if (first == "" || start < first + 0) first = start
+            if (start + wall > last) last = start + wall
+            if (stage == "encode") {
+                frames += field("duration") * fps
+                if (encode_first == "" || start < encode_first + 0) encode_first = start
+                if (start + wall > encode_last) encode_last = start + wall
+            }
+        }
+        END {
+            printf "%-12s %5s %10s %10s %10s %10s %10s\n", "stage", "runs", "wall s", "cpu s", "peak MiB", "read MiB", "write MiB"
+            for (i = 1; i <= num_stages; i++) {
+                s = order[i]
+                if (!(s in count)) continue
+                printf "%-12s %5d %10.1f %10.1f %10.1f %10.1f %10.1f\n", s, count[s], walls[s], cpu[s], peak[s] / 1024, read_bytes[s] / 1048576, written_bytes[s] / 1048576
+            }
+            if (walls["encode"] > 0 && encode_last > encode_first) {
+                printf "segment encode: %.2f fps per job, %.2f fps overall\n", frames / walls["encode"], frames / (encode_last - encode_first)
+            }
+            printf "crf search: %.1f s, final encode: %.1f s\n", walls["crf-search"], walls["encode"]
+            printf "audio: %.1f s, remux: %.1f s, total: %.1f s\n", walls["audio"], walls["remux"], last - first
+        }' > "$report_file"
+    cat "$report_file"
+}
+
+# encode titles back to back on one worker pool, preparing the next title
+# while the current one encodes
+run_queue() {
+    local titles=("$@")
+    local i next prepare_pid prepared
+    local status=0
+    local -a durations=()
+    # log directories of the titles of the run, for the throughput
+    titles_log_dirs=()
+    later_duration=0
+    if [ -n "$deadline_epoch" ]; then
+        for ((i=0; i<${#titles[@]}; i++)); do
+            load_title "${titles[i]}"
+            probe_media
+            durations[i]=${media[format.duration]:-0}
+            titles_log_dirs+=("$title_log_dir")
+        done
+        echo "Encoding ${#titles[@]} titles by $(date -d "@$deadline_epoch")"
+    fi
+
+    lease_next_title 0
+    i=$lease_index
+    if ((i == ${#titles[@]})); then
+        echo "Every title is leased by other coordinators"
+        rm -f "$queue_dir/$run_id"-*.skip
+        return 0
+    fi
+    load_title "${titles[i]}"
+    prepare_title &
+    prepare_pid=$!
+    wait_ready "$prepare_pid"
+    if [ "${#titles[@]}" -eq 1 ]; then
+        start_workers "$(count_pending_segments)" "${titles[@]}"
+    else
+        start_workers 0 "${titles[@]}"
+    fi
+
+    while ((i < ${#titles[@]})); do
+        if [ -n "$deadline_epoch" ]; then
+            # video of the titles after this one
+            later_duration=$(printf '%s\n' 0 "${durations[@]:i+1}" | awk '{sum += $1} END {print sum}')
+        fi
+        load_title "${titles[i]}"
+        wait "$prepare_pid"
+        prepared=$?
+        if [ "$(journal_last '"stage":"ready",' run)" != "$run_id" ]; then
+            journal stage=ready status=failed run="$run_id"
+        fi
+        lease_next_title $((i + 1))
+        next=$lease_index
+        load_title "${titles[i]}"
+        if ((next < ${#titles[@]})); then
+            (load_title "${titles[next]}" && prepare_title) &
+            prepare_pid=$!
+        fi
+        if [ "$prepared" -ne 0 ] || ! finish_title; then
+            status=1
+        fi
+        journal stage=ready status=closed run="$run_id"
+        release_scratch
+        release_lease
+        i=$next
+    done
+
+    rm -f "$queue_dir/$run_id"-*.job "$queue_dir/$run_id.preset"
+    wait "${worker_pids[@]}"
+    rm -f "$queue_dir/$run_id"-*.skip
+    return $status
+}
+
+# encode segments published on the shared videos volume by coordinators
+run_worker() {
+    local slot
+    plan_parallelism 0
+    for ((slot=0; slot<encode_jobs; slot++)); do
+        remote_worker "$slot" "$(slot_cpus "$slot")" &
+    done
+    wait
+}
+
+# find the input files, leaving out hidden files and .done markers
+input_files() {
+    find "$input_dir" -type f ! -name '.*' ! -name '*.done' "$@"
+}
+
+# print the input files in the order they should be encoded
+list_titles() {
+    local files f name
+    mapfile -t files < <(input_files -printf '%T@ %p\n' \
+        | sort -n \
+        | cut -d ' ' -f 2-)
+    case "$queue_order" in
+        shortest)
+            for f in "${files[@]}"; do
+                load_title "$f"
+                probe_media
+                printf '%s\t%s\n' "${media[format.duration]}" "$f"
+            done | sort -g | cut -f 2-
+            ;;
+        priority)
+            # titles named in the priority file first, the rest in fifo order
+            if [ -f "$priority_file" ]; then
+                while read -r name; do
+                    for f in "${files[@]}"; do
+                        if [ "$(basename "$f")" = "$name" ]; then
+                            echo "$f"
+                        fi
+                    done
+                done < "$priority_file"
+            fi
+            for f in "${files[@]}"; do
+                if ! grep -qxF "$(basename "$f")" "$priority_file" 2> /dev/null; then
+                    echo "$f"
+                fi
+            done
+            ;;
+        *)
+            printf '%s\n' "${files[@]}"
+            ;;
+    esac
+}
+
+# encode every title in the input directory that is not already done,
+# rescanning until nothing new turns up
+encode_queue() {
+    local f titles
+    local status=0
+    declare -A attempted
+    while true; do
+        titles=()
+        while read -r f; do
+            if [ -z "$f" ] || [ -n "${attempted[$f]}" ]; then
+                continue
+            fi
+            load_title "$f"
+            if title_complete; then
+                continue
+            fi
+            titles+=("$f")
+            attempted[$f]=1
+        done < <(list_titles)
+        if [ "${#titles[@]}" -eq 0 ]; then
+            break
+        fi
+        echo "Queued ${#titles[@]} titles"
+        run_queue "${titles[@]}" || status=1
+    done
+    echo "Queue complete"
+    return $status
+}
+
+# true once an input file is completely copied: its .done marker exists, or
+# its size is the same as on the last look and it was not written for
+# stable_seconds
+input_stable() {
+    local f=$1
+    local size mtime
+    if [ -f "$f.done" ]; then
+        return 0
+    fi
+    read -r size mtime < <(stat -c '%s %Y' "$f")
+    if [ "${input_sizes[$f]}" != "$size" ]; then
+        input_sizes[$f]=$size
+        return 1
+    fi
+    [ $((EPOCHSECONDS - mtime)) -ge "$stable_seconds" ]
+}
+
+# wait up to the given seconds for files to be written to the input directory
+wait_for_input() {
+    local timeout=$1
+    if command -v inotifywait > /dev/null; then
+        inotifywait -q -q -r -t "$timeout" -e close_write -e moved_to -e create "$input_dir"
+    else
+        sleep "$timeout"
+    fi
+}
+
+# encode titles as they are copied into the input directory, until stopped.
+# every batch of titles that became ready is encoded as a run of its own.
+encode_daemon() {
+    local f source
+    local titles=()
+    local waiting=0
+    declare -gA input_sizes=()
+    # titles already run, by source, so failed titles are retried only
+    # once they are replaced
+    declare -A attempted=()
+    echo "Watching $input_dir"
+    while true; do
+        titles=()
+        waiting=0
+        while read -r f; do
+            [ -n "$f" ] || continue
+            if ! input_stable "$f"; then
+                waiting=1
+                continue
+            fi
+            load_title "$f"
+            source=$(source_id)
+            if [ "${attempted[$f]}" = "$source" ] || title_complete; then
+                continue
+            fi
+            titles+=("$f")
+            attempted[$f]=$source
+        done < <(list_titles)
+        if [ "${#titles[@]}" -gt 0 ]; then
+            echo "Queued ${#titles[@]} titles"
+            run_id="$(date -u +%Y%m%dT%H%M%SZ)-$HOSTNAME-$(od -An -N4 -tx4 /dev/urandom | tr -d ' ')"
+            run_start=$EPOCHSECONDS
+            set_deadline || return 1
+            run_queue "${titles[@]}"
+            continue
+        fi
+        if [ "$waiting" -eq 1 ]; then
+            wait_for_input "$stable_seconds"
+        else
+            wait_for_input "$poll_interval"
+        fi
+    done
+}
+
+# set deadline_epoch from the deadline setting, empty without a deadline
+set_deadline() {
+    deadline_epoch=
+    if [ -z "$deadline" ]; then
+        return
+    fi
+    if ! deadline_epoch=$(date -d "$deadline" +%s); then
+        echo "Invalid deadline $deadline." >&2
+        return 1
+    fi
+    # a time of day that already passed today means tomorrow
+    if [ "$deadline_epoch" -le "$EPOCHSECONDS" ]; then
+        deadline_epoch=$((deadline_epoch + 86400))
+    fi
 }
 
 # create required directories
 mkdir -p \
     "$input_dir" \
-    "$segment_dir" \
-    "$working_dir" \
-    "$encoded_segment_dir" \
     "$output_dir" \
-    "$log_dir"
-
-# segment, encode, and remux
-echo "Begin segmenting video"
-segment_video
-echo "Begin encoding segments"
-encode_segments
-echo "Begin concatenating segments"
-concatenate_segments
-echo "Begin encoding audio"
-encode_audio
-echo "Begin remuxing tracks"
-remux_tracks
-echo "Encoding complete"
-
-# cleanup
-rm -rf \
-    "$segment_dir" \
-    "$encoded_segment_dir" \
-    "$working_dir"
\ No newline at end of file
+    "$log_dir" \
+    "$crf_cache_dir" \
+    "$probe_cache_dir" \
+    "$scene_cache_dir" \
+    "$segment_cache_dir" \
+    "$queue_dir" \
+    "$idle_dir" \
+    "$lease_dir"
+
+set_deadline || exit 1
+
+case "${1:-}" in
+    worker)
+        run_worker
+        ;;
+    queue)
+        encode_queue
+        exit $?
+        ;;
+    daemon)
+        encode_daemon
+        exit $?
+        ;;
+    *)
+        # Dynamically read the first filename in the input directory that no
+        # other coordinator has leased
+        input_path=
+        while read -r f; do
+            load_title "$f"
+            if ! title_leased; then
+                input_path=$f
+                break
+            fi
+        done < <(input_files)
+        if [ -z "$input_path" ]; then
+            echo "No input file found in $input_dir."
+            exit 1
+        fi
+        run_queue "$input_path"
+        exit $?
+        ;;
+esac
@@ -1,4 +1,27 @@
 #!/usr/bin/env bash
 
 mkdir -p $HOME/videos/input
-docker run --privileged -it --rm -v $HOME/videos:/app/videos encodingwf
\ No newline at end of file
+# settings of encode.sh passed on to the container when they are set here
+settings=(
+    QUEUE_ORDER STABLE_SECONDS POLL_INTERVAL
+    DISTRIBUTED LOCAL_ENCODE CLAIM_HEARTBEAT CLAIM_TIMEOUT
+    SEGMENT_SCRATCH ENCODED_SCRATCH AUDIO_SCRATCH MUX_SCRATCH
+    SEGMENT_CACHE_DIR SEGMENT_CACHE_MAX_SIZE ENCODED_RATIO
+    ENCODE_JOBS SVT_THREADS MIN_THREADS_PER_JOB MEMORY_RESERVE JOB_MEMORY_PER_MEGAPIXEL
+    CROP_SAMPLES SEGMENT_MODE SCENE_THRESHOLD
+    SEGMENT_MIN_DURATION SEGMENT_TARGET_DURATION SEGMENT_MAX_DURATION SPLIT_MIN_DURATION
+    STREAMING METRICS_INTERVAL
+    PRESET DEADLINE MIN_PRESET MAX_PRESET DEADLINE_MARGIN
+    MIN_VMAF VMAF_OPTIONS MIN_CRF MAX_CRF CRF_SAMPLES CRF_SAMPLE_DURATION CRF_SEARCH_JOBS
+    SAMPLE_BUFFER_DIR SAMPLE_BUFFER_SIZE SAMPLE_SPILL_SIZE CRF_CACHE_MAX_SIZE
+)
+env_args=()
+for setting in "${settings[@]}"; do
+    env_args+=(-e "$setting")
+done
+if [ "${1:-}" = "daemon" ]; then
+    # keep watching the input directory in the background across reboots
+    docker run --privileged -d --restart unless-stopped --name encodingwf --shm-size 8g "${env_args[@]}" -v $HOME/videos:/app/videos -v encodingwf-scratch:/app/scratch encodingwf daemon
+else
+    docker run --privileged -it --rm --shm-size 8g "${env_args[@]}" -v $HOME/videos:/app/videos -v encodingwf-scratch:/app/scratch encodingwf "$@"
+fi
@@ -0,0 +1,62 @@
+#!/usr/bin/env bash
+
+# run a coordinator and two worker nodes of encode.sh on this machine, with
+# stand-in encoder binaries from test/bin, and check that every title of the
+# input directory is encoded by the workers. the directories are kept for
+# inspection when the run fails.
+
+test_dir=$(cd "$(dirname "$0")" && pwd)
+root=$(mktemp -d)
+titles="${TITLES:-2}"
+timeout="${TIMEOUT:-600}"
+
+export PATH="$test_dir/bin:$PATH"
+export VIDEOS_DIR="$root/videos"
+export SCRATCH_DIR="$root/scratch"
+export DISTRIBUTED=1
+export CROP_SAMPLES=0
+export ENCODE_JOBS=2
+export CLAIM_HEARTBEAT=5
+export CLAIM_TIMEOUT=30
+
+mkdir -p "$VIDEOS_DIR/input"
+for ((i=1; i<=titles; i++)); do
+    echo "title $i" > "$VIDEOS_DIR/input/Title $i.mkv"
+done
+
+# each node has its own host name, like separate machines
+worker_pids=()
+for node in worker-1 worker-2; do
+    HOSTNAME=$node bash "$test_dir/../encode.sh" worker > "$root/$node.log" 2>&1 &
+    worker_pids+=("$!")
+done
+
+HOSTNAME=coordinator LOCAL_ENCODE=0 timeout "$timeout" \
+    bash "$test_dir/../encode.sh" queue > "$root/coordinator.log" 2>&1
+status=$?
+
+# the workers run until stopped, with their encodes in child processes
+for pid in "${worker_pids[@]}"; do
+    pkill -P "$pid"
+    kill "$pid" 2> /dev/null
+done
+wait
+
+for ((i=1; i<=titles; i++)); do
+    if [ ! -f "$VIDEOS_DIR/output/Title $i.mkv" ]; then
+        echo "Title $i was not encoded"
+        status=1
+    fi
+done
+for node in worker-1 worker-2; do
+    if ! grep -q " encoding .* segment " "$root/$node.log"; then
+        echo "$node did not encode any segment"
+        status=1
+    fi
+done
+if [ "$status" -ne 0 ]; then
+    echo "Failed, see $root"
+    exit 1
+fi
+echo "Passed"
+rm -rf "$root"